@@ -0,0 +1,197 @@
+"""
+End-to-end crawl benchmark against a local OData server and a fake bucket.
+
+Serves synthetic entity sets (dates, timestamps, geography and complex
+columns; see fixtures.py), or recorded ones from --fixtures, with
+odata_server.py in a child process, then fetches $metadata and runs
+scrape_all_entities (or the asyncio engine) over every entity set, uploading
+to fake_gcs.py's bucket. Checks each entity set's Avro blob holds all its
+rows and reports rows/sec, this process's peak RSS, and the seconds spent in
+each stage summed over entity sets, from the crawl's own metrics.RunReport.
+
+--save writes the results as JSON; --baseline compares against a saved run
+and exits non-zero if rows/sec fell, or peak RSS grew, by more than
+--tolerance.
+$ python3 benchmarks/bench_crawl.py --entities 8 --rows 20000 --workers 4
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from fastavro import block_reader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fake_gcs  # noqa: E402
+import http_session  # noqa: E402
+import odata_server  # noqa: E402
+from metrics import STAGES, RunReport  # noqa: E402
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def avro_rows(bucket, name):
+    with bucket.blob(name).open('rb') as avro_file:
+        return sum(block.num_records for block in block_reader(avro_file))
+
+
+def crawl(crawler, args, workdir):
+    """Runs the crawl and returns its RunReport and wall seconds."""
+    http_options = dict(pool_size=max(10, args.workers), backoff_factor=0.1)
+    schemas, entity_sets = crawler.fetch_metadata(
+        http_session.HttpClient(**http_options))
+    scrape_options = dict(
+        schemas=schemas,
+        entity_sets=entity_sets,
+        tempfile=os.path.join(workdir, 'crawl.avro'),
+        force=True,
+        skip_upload=False,
+        workers=args.workers,
+        pipeline_depth=args.pipeline_depth,
+        checkpoint_every=args.checkpoint_every,
+        stream_rows=args.stream_rows,
+        stream_upload=(8 * 1024 * 1024 if args.stream_upload else None),
+        report=RunReport(args.report))
+
+    started = time.monotonic()
+    if args.engine == 'asyncio':
+        asyncio.run(crawler.async_scrape_all_entities(
+            http=http_session.AsyncHttpClient(**http_options),
+            **scrape_options))
+    else:
+        crawler.scrape_all_entities(
+            http=http_session.HttpClient(**http_options), **scrape_options)
+    wall_seconds = time.monotonic() - started
+    scrape_options['report'].close(engine=args.engine,
+                                   wall_seconds=round(wall_seconds, 3),
+                                   http=http_session.stats.as_dict())
+    return scrape_options['report'], wall_seconds
+
+
+def check_regressions(results, baseline, tolerance):
+    """Returns what got worse than `baseline` by more than `tolerance`."""
+    regressions = []
+    if results['rows_per_second'] < (baseline['rows_per_second']
+                                     * (1 - tolerance)):
+        regressions.append(f'rows/sec {results["rows_per_second"]:,.0f} vs '
+                           f'{baseline["rows_per_second"]:,.0f}')
+    if results['peak_rss_mib'] > baseline['peak_rss_mib'] * (1 + tolerance):
+        regressions.append(f'peak RSS {results["peak_rss_mib"]:.0f} MiB vs '
+                           f'{baseline["peak_rss_mib"]:.0f} MiB')
+    return regressions
+
+
+def main(args):
+    if args.fixtures:
+        load, load_args = odata_server.recorded_fixtures, (args.fixtures,)
+    else:
+        load, load_args = (odata_server.synthetic_fixtures,
+                           (args.entities, args.rows))
+    server, endpoint, row_counts = odata_server.start_server_process(
+        load, load_args, page_size=args.page_size, latency=args.latency)
+
+    # ospi-odata-load makes its storage client when imported.
+    fake_gcs.install()
+    crawler = importlib.import_module('ospi-odata-load')
+    crawler.ODATA_ENDPOINT = endpoint
+    rss_before = peak_rss_mib()
+
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            report, wall_seconds = crawl(crawler, args, workdir)
+    finally:
+        server.terminate()
+
+    totals = {entity['entity']: entity for entity in report.entities}
+    for entity, expected in row_counts.items():
+        name = f'{crawler.entity_path(entity)}.avro'
+        if (totals[entity]['status'] != 'ok'
+                or avro_rows(crawler.bucket, name) != expected):
+            raise AssertionError(f'{entity}: expected {expected} rows in '
+                                 f'{name}, got {totals[entity]}')
+
+    rows = sum(entity['rows'] for entity in report.entities)
+    stage_seconds = {stage: sum(entity[f'{stage}_seconds']
+                                for entity in report.entities)
+                     for stage in STAGES}
+    results = {
+        'engine': args.engine,
+        'entities': len(report.entities),
+        'rows': rows,
+        'wall_seconds': round(wall_seconds, 3),
+        'rows_per_second': round(rows / wall_seconds, 1),
+        'peak_rss_mib': round(peak_rss_mib(), 1),
+        'uploaded_mib': round(crawler.bucket.stored_bytes() / 2 ** 20, 1),
+        'stage_seconds': {stage: round(seconds, 3)
+                          for stage, seconds in stage_seconds.items()},
+        'http': http_session.stats.as_dict(),
+    }
+
+    print(f'{args.engine}: {results["entities"]} entity sets, {rows:,} rows '
+          f'in {wall_seconds:.2f}s, {results["rows_per_second"]:,.0f} '
+          f'rows/sec')
+    print(f'peak RSS:   {results["peak_rss_mib"]:8.1f} MiB '
+          f'({rss_before:.1f} MiB before the crawl)')
+    stage_total = sum(stage_seconds.values()) or 1.0
+    for stage, seconds in stage_seconds.items():
+        print(f'{stage + ":":11} {seconds:8.3f}s '
+              f'({seconds / stage_total:4.0%} of stage time)')
+    print(f'uploaded:   {results["uploaded_mib"]:8.1f} MiB')
+    print(f'http:       {results["http"]}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as save_file:
+            json.dump(results, save_file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = check_regressions(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit(f'Regressed against {args.baseline}: '
+                     + '; '.join(regressions))
+        print(f'No regression against {args.baseline}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--fixtures',
+                        help='Directory of recorded fixtures (see '
+                             'odata_server.py); synthetic entity sets are '
+                             'crawled if not given')
+    parser.add_argument('--entities', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=20000,
+                        help='Rows per synthetic entity set')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the server waits before each page')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'],
+                        default='threads')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--pipeline-depth', type=int, default=2)
+    parser.add_argument('--checkpoint-every', type=int, default=100)
+    parser.add_argument('--stream-rows', type=int, default=1000)
+    parser.add_argument('--stream-upload', action='store_true')
+    parser.add_argument('--report',
+                        help='Also write the crawl\'s metrics report here')
+    parser.add_argument('--save', help='Write the results as JSON here')
+    parser.add_argument('--baseline',
+                        help='Results saved by an earlier --save to compare '
+                             'against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed fraction of regression against '
+                             '--baseline (default: %(default)s)')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+    main(args)
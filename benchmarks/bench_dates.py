@@ -0,0 +1,94 @@
+"""
+Benchmark of the Edm.Date / Edm.DateTimeOffset conversions.
+
+Times the fromisoformat + timedelta conversion the transforms used to do for
+every value against the cached fast path (row at a time) and the batch
+converters (column at a time), over the date columns of the synthetic
+entity, and then the whole-entity page transform.
+$ python3 benchmarks/bench_dates.py --rows 100000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fixtures  # noqa: E402
+import odata  # noqa: E402
+
+
+def uncached_days(x):
+    return None if x is None else odata._since_epoch(x).days
+
+
+def uncached_millis(x):
+    if x is None:
+        return None
+    return round(odata._since_epoch(x) / timedelta(milliseconds=1))
+
+
+UNCACHED = {
+    odata.transform_edm_date_to_epoch_days: uncached_days,
+    odata.transform_edm_date_to_millis: uncached_millis,
+}
+
+
+def timed(fn, *args):
+    odata._epoch_days.cache_clear()
+    odata._epoch_millis.cache_clear()
+    gc.collect()
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main(row_count):
+    schema = odata.get_schemas(
+        ET.fromstring(fixtures.METADATA))[fixtures.ENTITY]
+    rows = fixtures.synthetic_rows(row_count)
+
+    date_columns = [(name, field['transform'])
+                    for name, field in schema.items()
+                    if field['transform'] in UNCACHED]
+    for name, transform in date_columns:
+        column = [row[name] for row in rows]
+        distinct = len(set(column))
+
+        baseline, expected = timed(
+            lambda: [UNCACHED[transform](v) for v in column])
+        cached, by_row = timed(lambda: [transform(v) for v in column])
+        batched, by_column = timed(odata.BATCH_TRANSFORMS[transform], column)
+        if not expected == by_row == by_column:
+            raise AssertionError(f'{name}: conversions differ')
+
+        print(f'{name} ({distinct} distinct): '
+              f'fromisoformat {row_count / baseline:12,.0f}/s  '
+              f'cached {row_count / cached:12,.0f}/s '
+              f'({baseline / cached:.1f}x)  '
+              f'batch {row_count / batched:12,.0f}/s '
+              f'({baseline / batched:.1f}x)')
+
+    uncached_schema = {
+        name: dict(field, transform=UNCACHED.get(field['transform'],
+                                                 field['transform']))
+        for name, field in schema.items()}
+    baseline, expected = timed(
+        odata.compile_page_transform(uncached_schema), rows)
+    elapsed, actual = timed(odata.compile_page_transform(schema), rows)
+    if actual != expected:
+        raise AssertionError('page transform output differs')
+    print(f'{fixtures.ENTITY} page transform: '
+          f'{row_count / baseline:12,.0f} -> {row_count / elapsed:12,.0f} '
+          f'rows/sec ({baseline / elapsed:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+    main(args.rows)
@@ -0,0 +1,79 @@
+"""
+Benchmark of WKT (and WKB) generation for geography columns.
+
+Compares the original per-point f-string WKT builder with the batched
+odata.encode_geography over synthetic district-boundary multipolygons, and
+checks the WKT is byte-identical.
+$ python3 benchmarks/bench_geography.py --rows 2000 --points 500
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fixtures  # noqa: E402
+import odata  # noqa: E402
+
+
+def per_point_multipolygon(x):
+    """The original transform_edm_multipolygon_to_multipolygon."""
+    if x is None:
+        return x
+
+    if x['type'] != 'MultiPolygon':
+        raise ValueError(x)
+
+    coordinates = x['coordinates']
+    return 'MULTIPOLYGON (%s)' % ','.join(
+        ['(%s)' % ','.join([
+            '(%s)' % ','.join([f'{point[0]} {point[1]}'
+                               for point in multipoint])
+            for multipoint in polygon])
+         for polygon in coordinates])
+
+
+def timed(fn, *args, **kwargs):
+    gc.collect()
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main(row_count, points):
+    rng = random.Random(0)
+    column = [{'type': 'MultiPolygon',
+               'coordinates': [fixtures._polygon(rng, points)
+                               for _ in range(1 + i % 3)]}
+              for i in range(row_count)]
+    point_count = sum(len(ring) for value in column
+                      for polygon in value['coordinates']
+                      for ring in polygon)
+
+    baseline, expected = timed(
+        lambda: [per_point_multipolygon(v) for v in column])
+    print(f'per-point WKT: {point_count / baseline:14,.0f} points/sec')
+
+    elapsed, actual = timed(odata.encode_geography, column, 'MultiPolygon')
+    if actual != expected:
+        raise AssertionError('batched WKT differs from the original')
+    print(f'batched WKT:   {point_count / elapsed:14,.0f} points/sec '
+          f'({baseline / elapsed:.2f}x)')
+
+    elapsed, _ = timed(odata.encode_geography, column, 'MultiPolygon',
+                       wkb=True)
+    print(f'batched WKB:   {point_count / elapsed:14,.0f} points/sec '
+          f'({baseline / elapsed:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--points', type=int, default=500,
+                        help='points per polygon ring')
+    args = parser.parse_args()
+    main(args.rows, args.points)
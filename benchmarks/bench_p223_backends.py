@@ -0,0 +1,65 @@
+"""
+Parity check and benchmark of the P223 PDF text backends.
+
+Extracts every PDF with each backend of p223_pdf_text, in this process, and
+reports seconds per PDF and whether the rows parsed from each backend's text
+match those from pdftotext, the reference backend.
+$ python3 benchmarks/bench_p223_backends.py path/to/pdfs/*.pdf
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'extractors'))
+
+import p223_pdf_text  # noqa: E402
+import p223_pdf_to_csv  # noqa: E402
+
+
+def extract(backend, paths):
+    rows = {}
+    start = time.perf_counter()
+    for path in paths:
+        with backend.lines(path, first_page=2) as lines:
+            rows[path] = list(p223_pdf_to_csv.iter_rows(lines))
+    return time.perf_counter() - start, rows
+
+
+def main(paths, backend_names):
+    reference = None
+    for name in backend_names:
+        try:
+            backend = p223_pdf_text.get_backend(name)
+        except RuntimeError as e:
+            print(f'{name + ":":10} skipped, {e}')
+            continue
+
+        elapsed, rows = extract(backend, paths)
+        row_count = sum(len(pdf_rows) for pdf_rows in rows.values())
+        line = (f'{name + ":":10} {elapsed / len(paths) * 1000:8.1f} ms/PDF, '
+                f'{row_count:,} rows')
+        if reference is None:
+            reference = name, rows
+        else:
+            differing = [path for path in paths
+                         if rows[path] != reference[1][path]]
+            line += (f', {len(differing)} of {len(paths)} PDFs differ '
+                     f'from {reference[0]}')
+            for path in differing:
+                line += f'\n    {path}'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('paths', nargs='+', help='P223 PDFs')
+    parser.add_argument('--backends', nargs='+',
+                        default=sorted(p223_pdf_text.BACKENDS,
+                                       key=lambda name: name != 'pdftotext'),
+                        choices=sorted(p223_pdf_text.BACKENDS),
+                        help='Backends to run; the first is the reference')
+    args = parser.parse_args()
+    main(args.paths, args.backends)
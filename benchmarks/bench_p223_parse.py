@@ -0,0 +1,157 @@
+"""
+Benchmark of the P223 text parser.
+
+Times the original parser, which squished every line with re.sub and built
+a dict of every school before writing, against the single-pass
+p223_pdf_to_csv.iter_rows streaming rows into the CSV writer and against
+p223_pdf_to_csv.iter_column_rows, over a corpus of pdftotext output files
+(or a synthetic one), and reports lines/sec and peak traced memory.
+$ python3 benchmarks/bench_p223_parse.py path/to/squished/*.txt
+$ python3 benchmarks/bench_p223_parse.py --synthetic-files 24
+"""
+
+import argparse
+import csv
+import gc
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'extractors'))
+
+import fixtures  # noqa: E402
+import p223_pdf_to_csv  # noqa: E402
+
+K_12_LINE_REGEX = re.compile('^ ([1-9K][0-2]?)')
+
+
+def original_get_grade(line):
+    if line.startswith('Gr: Preschool'):
+        return 'Preschool', line[len('Gr: Preschool'):].strip()
+    if (line.startswith(' State FDK')
+            and not line.startswith(' State FDK =')):
+        return 'K', line[len(' State FDK'):].strip()
+    m = K_12_LINE_REGEX.match(line)
+    if m:
+        grade = m.group(1)
+        return grade, line[len(grade) + 1:].strip()
+    return None, None
+
+
+def original(infile, outfile):
+    p233_data = {}
+    school = None
+    for line in infile:
+        line = re.sub(r'\s+', ' ', line)
+        if line.startswith('School: '):
+            school = {}
+            p233_data[line[len('School: '):].strip()] = school
+        else:
+            grade, remaining = original_get_grade(line)
+            if grade and remaining:
+                school[grade] = [float(x) for x in remaining.split(' ')]
+
+    writer = csv.writer(outfile)
+    writer.writerow(['School', 'Grade'] + p223_pdf_to_csv.HEADERS)
+    for school, gradeinfo in p233_data.items():
+        for grade, data in gradeinfo.items():
+            writer.writerow([school, grade] + data)
+
+
+def streaming(infile, outfile):
+    p223_pdf_to_csv.write_csv(p223_pdf_to_csv.iter_rows(infile), outfile)
+
+
+def columns(infile, outfile):
+    p223_pdf_to_csv.write_csv(p223_pdf_to_csv.iter_column_rows(infile),
+                              outfile)
+
+
+def run(fn, paths, outfile):
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as infile:
+            fn(infile, outfile)
+
+
+def best_of(repeat, fn, paths):
+    best = None
+    with open(os.devnull, 'w', newline='') as outfile:
+        for _ in range(repeat):
+            gc.collect()
+            start = time.perf_counter()
+            run(fn, paths, outfile)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_memory(fn, paths):
+    """Peak memory allocated while parsing the largest of `paths`."""
+    largest = max(paths, key=os.path.getsize)
+    with open(os.devnull, 'w', newline='') as outfile:
+        gc.collect()
+        tracemalloc.start()
+        run(fn, [largest], outfile)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return peak
+
+
+def output(fn, paths):
+    outfile = io.StringIO(newline='')
+    run(fn, paths, outfile)
+    return outfile.getvalue()
+
+
+def main(paths, repeat):
+    lines = 0
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as infile:
+            lines += sum(1 for _ in infile)
+    print(f'{len(paths)} files, {lines:,} lines')
+
+    expected = output(original, paths)
+    if output(streaming, paths) != expected:
+        raise AssertionError('streaming parser output differs')
+    if output(columns, paths) != expected:
+        print('column parser output differs (blank cells?)')
+
+    baseline = best_of(repeat, original, paths)
+    for name, fn in [('original', original), ('streaming', streaming),
+                     ('columns', columns)]:
+        elapsed = baseline if fn is original else best_of(repeat, fn, paths)
+        peak = peak_memory(fn, paths)
+        print(f'{name + ":":11} {lines / elapsed:12,.0f} lines/sec '
+              f'({baseline / elapsed:.2f}x), '
+              f'peak {peak / 1024 / 1024:7.2f} MiB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('paths', nargs='*',
+                        help='pdftotext -layout output files to parse')
+    parser.add_argument('--synthetic-files', type=int, default=24,
+                        help='Files to generate when no paths are given')
+    parser.add_argument('--schools', type=int, default=100,
+                        help='Schools per generated file')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.paths:
+        main(args.paths, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for seed in range(args.synthetic_files):
+                path = os.path.join(directory, f'p223-{seed}.txt')
+                with open(path, 'w', encoding='utf-8') as synthetic:
+                    synthetic.write(
+                        fixtures.synthetic_p223_text(args.schools, seed))
+                paths.append(path)
+            main(paths, args.repeat)
@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of the per-row transform.
+
+Compares the original per-field dict comprehension, which looks up
+`schema[field]['transform']` for every value, against the transformer built
+once per schema by odata.compile_transform.
+$ python3 benchmarks/bench_transform.py --rows 50000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fixtures  # noqa: E402
+from odata import compile_transform, get_schemas  # noqa: E402
+
+
+def per_field(schema, rows):
+    return [
+        {field_name: schema[field_name]['transform'](field_value)
+         for field_name, field_value in row.items()}
+        for row in rows]
+
+
+def compiled(schema, rows):
+    transform_row = compile_transform(schema)
+    return [transform_row(row) for row in rows]
+
+
+def best_of(repeat, fn, *args):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(row_count, repeat):
+    schema = get_schemas(ET.fromstring(fixtures.METADATA))[fixtures.ENTITY]
+    rows = fixtures.synthetic_rows(row_count)
+
+    baseline, expected = best_of(repeat, per_field, schema, rows)
+    print(f'per-field:  {row_count / baseline:12,.0f} rows/sec')
+
+    elapsed, actual = best_of(repeat, compiled, schema, rows)
+    if actual != expected:
+        raise AssertionError('compiled transform output differs')
+    print(f'compiled:   {row_count / elapsed:12,.0f} rows/sec '
+          f'({baseline / elapsed:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.rows, args.repeat)
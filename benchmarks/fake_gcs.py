@@ -0,0 +1,142 @@
+"""
+In-memory stand-in for the google.cloud.storage client the crawler writes
+through, for offline benchmarks.
+
+Covers the Client, Bucket and Blob calls ospi-odata-load makes: uploads,
+downloads, listing, compose, delete and `open()`, including resumable
+uploads.
+install() must run before ospi-odata-load is imported, since that module
+creates its storage client at import time.
+"""
+
+import io
+import itertools
+import threading
+
+from google.cloud import storage
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        stored = bucket.objects.get(name)
+        self.metadata = stored and stored['metadata']
+        self.content_type = stored and stored['content_type']
+
+    def _stored(self):
+        return self.bucket.objects[self.name]
+
+    @property
+    def generation(self):
+        return self._stored()['generation']
+
+    @property
+    def size(self):
+        return len(self._stored()['data'])
+
+    def exists(self, **kwargs):
+        return self.name in self.bucket.objects
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode()
+        self.bucket.store(self.name, data, content_type or self.content_type,
+                          self.metadata)
+
+    def upload_from_filename(self, filename, content_type=None, **kwargs):
+        with open(filename, 'rb') as uploaded_file:
+            self.upload_from_string(uploaded_file.read(), content_type)
+
+    def download_as_bytes(self, **kwargs):
+        return self._stored()['data']
+
+    def download_as_text(self, **kwargs):
+        return self.download_as_bytes().decode()
+
+    def download_to_file(self, file_obj, **kwargs):
+        file_obj.write(self.download_as_bytes())
+
+    def compose(self, sources, **kwargs):
+        self.upload_from_string(b''.join(source.download_as_bytes()
+                                         for source in sources))
+
+    def delete(self, **kwargs):
+        with self.bucket.lock:
+            del self.bucket.objects[self.name]
+
+    def open(self, mode='rb', chunk_size=None, content_type=None, **kwargs):
+        if mode == 'rb':
+            return io.BytesIO(self.download_as_bytes())
+        if mode == 'wb':
+            return FakeBlobWriter(self, content_type)
+        raise ValueError(f'unsupported mode {mode!r}')
+
+
+class FakeBlobWriter(io.RawIOBase):
+    """Resumable upload of a FakeBlob, stored once closed."""
+
+    def __init__(self, blob, content_type):
+        self.blob = blob
+        self.content_type = content_type
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def tell(self):
+        return self.buffer.tell()
+
+    def close(self):
+        if not self.closed:
+            self.blob.upload_from_string(self.buffer.getvalue(),
+                                         self.content_type)
+        super().close()
+
+    def terminate(self):
+        super().close()
+
+
+class FakeBucket:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.generations = itertools.count(1)
+
+    def store(self, name, data, content_type, metadata):
+        with self.lock:
+            self.objects[name] = {'data': data, 'content_type': content_type,
+                                  'metadata': metadata,
+                                  'generation': next(self.generations)}
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix='', **kwargs):
+        with self.lock:
+            names = sorted(name for name in self.objects
+                           if name.startswith(prefix))
+        return [FakeBlob(self, name) for name in names]
+
+    def stored_bytes(self):
+        with self.lock:
+            return sum(len(stored['data'])
+                       for stored in self.objects.values())
+
+
+class FakeClient:
+    def __init__(self, project=None, **kwargs):
+        self.project = project
+        self.buckets = {}
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, FakeBucket(name))
+
+
+def install():
+    """Makes storage.Client a FakeClient."""
+    storage.Client = FakeClient
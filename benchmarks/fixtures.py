@@ -0,0 +1,123 @@
+"""
+Synthetic OSPI-like $metadata and rows for the benchmarks.
+
+The one entity, `bench-0001`, mixes the column types that are expensive to
+transform: dates, timestamps, geography and a complex (socrata.url) type,
+alongside plain strings and numbers. synthetic_metadata declares any number
+of entity sets like it, for the crawl benchmark.
+
+synthetic_p223_text stands in for the `pdftotext -layout` output of a P223
+enrollment report, for the extractors/ benchmarks.
+"""
+
+import random
+
+ENTITY = 'bench-0001'
+
+
+def synthetic_metadata(entities):
+    """Returns $metadata declaring each of `entities` with ENTITY's columns,
+    under an entity type of the same name, as Socrata does.
+    """
+    types = ''.join(f'''
+      <EntityType Name="{entity}">
+        <Key><PropertyRef Name="__id"/></Key>
+        <Property Name="__id" Type="Edm.String"/>
+        <Property Name="schoolname" Type="Edm.String"/>
+        <Property Name="districtcode" Type="Edm.String"/>
+        <Property Name="gradelevel" Type="Edm.String"/>
+        <Property Name="numerator" Type="Edm.Double"/>
+        <Property Name="denominator" Type="Edm.Double"/>
+        <Property Name="enrollment" Type="Edm.Int64"/>
+        <Property Name="schoolyear" Type="Edm.Date"/>
+        <Property Name="datasetdate" Type="Edm.Date"/>
+        <Property Name="updated" Type="Edm.DateTimeOffset"/>
+        <Property Name="website" Type="socrata.url"/>
+        <Property Name="location" Type="Edm.GeographyPoint"/>
+        <Property Name="boundary" Type="Edm.GeographyMultiPolygon"/>
+      </EntityType>''' for entity in entities)
+    sets = ''.join(f'\n        <EntitySet Name="{entity}" '
+                   f'EntityType="socrata.{entity}"/>' for entity in entities)
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<edmx:Edmx xmlns:edmx="http://docs.oasis-open.org/odata/ns/edmx"
+           Version="4.0">
+  <edmx:DataServices>
+    <Schema xmlns="http://docs.oasis-open.org/odata/ns/edm"
+            Namespace="socrata">
+      <ComplexType Name="url">
+        <Property Name="url" Type="Edm.String"/>
+        <Property Name="description" Type="Edm.String"/>
+      </ComplexType>{types}
+      <EntityContainer Name="Service">{sets}
+      </EntityContainer>
+    </Schema>
+  </edmx:DataServices>
+</edmx:Edmx>
+'''
+
+
+METADATA = synthetic_metadata([ENTITY])
+
+
+def _polygon(rng, points):
+    ring = [[round(rng.uniform(-124.8, -116.9), 6),
+             round(rng.uniform(45.5, 49.0), 6)] for _ in range(points - 1)]
+    return [ring + [ring[0]]]
+
+
+def synthetic_rows(count, seed=0, boundary_points=40):
+    """Returns `count` raw OData rows for ENTITY, as json.loads gives them."""
+    rng = random.Random(seed)
+    years = [f'{year}-09-01T00:00:00.000Z' for year in range(2010, 2025)]
+    rows = []
+    for i in range(count):
+        day = 1 + i % 28
+        rows.append({
+            '__id': f'row-{i:08d}',
+            'schoolname': f'School {i % 500}',
+            'districtcode': f'{17000 + i % 300:05d}',
+            'gradelevel': rng.choice(['K', '1', '2', '3', '9', '12', 'All']),
+            'numerator': float(rng.randint(0, 500)),
+            'denominator': float(rng.randint(1, 500)),
+            'enrollment': rng.randint(0, 3000),
+            'schoolyear': rng.choice(years),
+            'datasetdate': f'2024-{1 + i % 12:02d}-{day:02d}T00:00:00.000Z',
+            'updated': f'2024-{1 + i % 12:02d}-{day:02d}T'
+                       f'{i % 24:02d}:{i % 60:02d}:00.000Z',
+            'website': ({'url': f'https://example.org/{i % 500}',
+                         'description': None} if i % 4 else None),
+            'location': {'type': 'Point',
+                         'coordinates': [round(rng.uniform(-124, -117), 6),
+                                         round(rng.uniform(45.5, 49), 6)]},
+            'boundary': ({'type': 'MultiPolygon',
+                          'coordinates': [_polygon(rng, boundary_points)]}
+                         if i % 10 == 0 else None),
+        })
+    return rows
+
+
+P223_GRADES = ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12']
+
+
+def synthetic_p223_text(schools, seed=0):
+    """Returns P223 report text for `schools` schools, laid out in columns
+    as `pdftotext -layout` writes them, one page per school.
+    """
+    rng = random.Random(seed)
+
+    def values(high):
+        return '   '.join(f'{rng.uniform(0, high):>8.2f}' for _ in range(9))
+
+    lines = ['                    P223 Enrollment Report', '']
+    for school in range(schools):
+        lines.append(f'School: School Number {school} Elementary')
+        lines.append('                 Regular   Bilingual   Spec. Ed.   Male'
+                     '   Female   Non-Binary   Total   P223 Total   P223 FTE')
+        lines.append(f'Gr: Preschool   {values(50)}')
+        lines.append(f'   State FDK    {values(90)}')
+        lines.append(f'   State FDK =  {values(90)}')
+        for grade in P223_GRADES:
+            lines.append(f'   {grade:<4}         {values(120)}')
+        lines.append(f'   Total        {values(900)}')
+        lines.append('\f')
+    return '\n'.join(lines) + '\n'
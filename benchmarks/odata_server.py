@@ -0,0 +1,183 @@
+"""
+Local stand-in for the data.wa.gov OData endpoint.
+
+Serves $metadata and the pages of each entity set, linked by
+@odata.nextLink and gzipped when the client asks, from fixtures that are
+either synthetic (see fixtures.py) or recorded from the real endpoint: a
+directory holding `$metadata.xml` and one `<entity set>.json` per entity
+set, each a list of rows or a saved OData response with a `value` list.
+$ python3 benchmarks/odata_server.py --entities 4 --rows 20000
+"""
+
+import argparse
+import glob
+import gzip
+import http.server
+import json
+import multiprocessing
+import os
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import fixtures
+
+BASE_PATH = '/api/odata/v4'
+
+
+def synthetic_fixtures(entities, rows, seed=0):
+    """Returns (metadata, rows by entity set) for `entities` synthetic
+    entity sets of `rows` rows each.
+    """
+    names = [f'bench-{i + 1:04d}' for i in range(entities)]
+    entity_rows = fixtures.synthetic_rows(rows, seed)
+    return (fixtures.synthetic_metadata(names),
+            {name: entity_rows for name in names})
+
+
+def recorded_fixtures(directory):
+    """Returns (metadata, rows by entity set) recorded in `directory`."""
+    with open(os.path.join(directory, '$metadata.xml'),
+              encoding='utf-8') as metadata_file:
+        metadata = metadata_file.read()
+
+    entity_rows = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        with open(path, encoding='utf-8') as rows_file:
+            recorded = json.load(rows_file)
+        if isinstance(recorded, dict):
+            recorded = recorded['value']
+        entity_rows[os.path.basename(path)[:-len('.json')]] = recorded
+    return metadata, entity_rows
+
+
+class OdataHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, Nagle and
+    # delayed ACKs hold every body back ~40ms.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        name = url.path[len(BASE_PATH) + 1:]
+        if not url.path.startswith(BASE_PATH + '/'):
+            return self.send_body(404, b'')
+        if name == '$metadata':
+            return self.send_body(200, *self.server.metadata,
+                                  content_type='application/xml')
+
+        pages = self.server.pages.get(name)
+        if pages is None:
+            return self.send_body(404, b'')
+        skip = int(parse_qs(url.query).get('$skiptoken', ['0'])[0])
+        index = skip // self.server.page_size
+        if index >= len(pages) or skip % self.server.page_size:
+            return self.send_body(400, b'')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_body(200, *pages[index], content_type='application/json')
+
+    def send_body(self, status, body, gzipped=None,
+                  content_type='text/plain'):
+        gzip_it = (gzipped is not None
+                   and 'gzip' in self.headers.get('Accept-Encoding', ''))
+        if gzip_it:
+            body = gzipped
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if gzip_it:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class OdataServer(http.server.ThreadingHTTPServer):
+    """OData endpoint on 127.0.0.1 serving `entity_rows` in pages of
+    `page_size`, each after `latency` seconds. Every body is encoded, and
+    gzipped, up front so that serving costs next to nothing.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, metadata, entity_rows, page_size=1000, latency=0.0,
+                 port=0):
+        super().__init__(('127.0.0.1', port), OdataHandler)
+        self.page_size = page_size
+        self.latency = latency
+        self.metadata = self.encode(metadata.encode())
+        self.pages = {name: self.encode_pages(name, rows)
+                      for name, rows in entity_rows.items()}
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server_port}{BASE_PATH}'
+
+    @staticmethod
+    def encode(body):
+        """Returns `body` and its gzipped form."""
+        return body, gzip.compress(body, compresslevel=6)
+
+    def encode_pages(self, name, rows):
+        pages = []
+        for skip in range(0, max(len(rows), 1), self.page_size):
+            page = {'@odata.context': f'{self.endpoint}/$metadata#{name}',
+                    'value': rows[skip:skip + self.page_size]}
+            next_skip = skip + self.page_size
+            if next_skip < len(rows):
+                page['@odata.nextLink'] = (f'{self.endpoint}/{name}'
+                                           f'?$skiptoken={next_skip}')
+            pages.append(self.encode(json.dumps(page).encode()))
+        return pages
+
+
+def _serve(connection, load, load_args, kwargs):
+    metadata, entity_rows = load(*load_args)
+    server = OdataServer(metadata, entity_rows, **kwargs)
+    connection.send((server.endpoint,
+                     {name: len(rows) for name, rows in entity_rows.items()}))
+    connection.close()
+    server.serve_forever()
+
+
+def start_server_process(load, load_args, **kwargs):
+    """Runs an OdataServer of the fixtures returned by `load(*load_args)`
+    (synthetic_fixtures or recorded_fixtures) in a child process, so that
+    neither the server nor its fixtures take the GIL or memory of the
+    process under test. `kwargs` go to OdataServer.
+
+    Returns the process, the endpoint URL once the server is listening,
+    and the number of rows of each entity set.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, daemon=True,
+                                      args=(child, load, load_args, kwargs))
+    process.start()
+    endpoint, row_counts = parent.recv()
+    return process, endpoint, row_counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--fixtures',
+                        help='Directory of recorded fixtures; synthetic '
+                             'entity sets are served if not given')
+    parser.add_argument('--entities', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=20000,
+                        help='Rows per synthetic entity set')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before serving each page')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    if args.fixtures:
+        metadata, entity_rows = recorded_fixtures(args.fixtures)
+    else:
+        metadata, entity_rows = synthetic_fixtures(args.entities, args.rows)
+    server = OdataServer(metadata, entity_rows, args.page_size, args.latency,
+                         args.port)
+    print(f'Serving {len(entity_rows)} entity sets at {server.endpoint}')
+    server.serve_forever()
@@ -0,0 +1,206 @@
+"""
+Loads the Avro files of scraped entity sets into BigQuery tables.
+
+Table schemas come from the `sql_type` of each column in odata.get_schemas.
+A table is replaced with the entity's full Avro file, then each delta
+partition written since by an incremental run is loaded into a staging
+table and MERGEd in on `__id`, so updated rows replace their old versions
+rather than being added again.
+
+Every table is labelled with a fingerprint of the blobs it was loaded from,
+so tables whose blobs have not changed since are skipped.
+"""
+
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_LABEL = 'source_fingerprint'
+
+# Deltas are loaded into `{table}{STAGING_SUFFIX}` before being merged.
+STAGING_SUFFIX = '__delta_staging'
+
+# odata sql_type to BigQuery column type, where the two differ. DATETIME
+# columns are written as Avro timestamp-millis, which loads as TIMESTAMP.
+BIGQUERY_TYPES = {
+    'BOOL': 'BOOLEAN',
+    'DATETIME': 'TIMESTAMP',
+    'SMALLINT': 'INT64',
+    'INT': 'INT64',
+    'BIGINT': 'INT64',
+    'TINYINT': 'INT64',
+    'STRUCT': 'RECORD',
+}
+
+
+class LoadError(Exception):
+    """Some tables failed to load; `failed` names their entities."""
+
+    def __init__(self, failed, loaded):
+        super().__init__(f'{len(failed)} tables failed to load: '
+                         f'{", ".join(sorted(failed))}')
+        self.failed = failed
+        self.loaded = loaded
+
+
+def to_schema_field(name, type_info, mode='NULLABLE'):
+    sql_type = type_info['sql_type']
+    fields = ()
+    if sql_type == 'STRUCT':
+        fields = [to_schema_field(field['name'], field)
+                  for field in type_info['avro_type']['fields']]
+    return bigquery.SchemaField(name, BIGQUERY_TYPES.get(sql_type, sql_type),
+                                mode=mode, fields=fields)
+
+
+def to_bigquery_schema(schema):
+    """BigQuery schema of an entity schema from odata.get_schemas."""
+    return [to_schema_field(name, type_info,
+                            'REQUIRED' if name == '__id' else 'NULLABLE')
+            for name, type_info in schema.items()]
+
+
+def table_name(entity):
+    return entity.replace('-', '_')
+
+
+def merge_query(table_id, staging_id, schema, order_column):
+    """MERGE of the rows of `staging_id` into `table_id` by `__id`.
+
+    A row updated twice while one delta was paged appears in it twice, and
+    MERGE needs one source row per target row: the copy with the latest
+    `order_column`, the watermark column of the delta, is kept.
+    """
+    updates = ', '.join(f'`{field.name}` = source.`{field.name}`'
+                        for field in schema if field.name != '__id')
+    return (f'MERGE `{table_id}` target\n'
+            f'USING (SELECT * FROM `{staging_id}` WHERE TRUE\n'
+            f'       QUALIFY ROW_NUMBER() OVER (\n'
+            f'           PARTITION BY __id ORDER BY `{order_column}` DESC)'
+            f' = 1) source\n'
+            f'ON target.__id = source.__id\n'
+            f'WHEN MATCHED THEN UPDATE SET {updates}\n'
+            f'WHEN NOT MATCHED THEN INSERT ROW')
+
+
+def fingerprint(blobs):
+    """Short digest of the names and generations of `blobs`, fit for a
+    BigQuery label value.
+    """
+    digest = hashlib.sha256()
+    for blob in sorted(blobs, key=lambda blob: blob.name):
+        digest.update(f'{blob.name}#{blob.generation}\n'.encode())
+    return digest.hexdigest()[:32]
+
+
+class BigQueryClient:
+    """The BigQuery calls made by load_tables.
+
+    Anything with the same two methods can stand in for it, such as an
+    in-memory fake in tests.
+    """
+
+    def __init__(self, project, dataset):
+        self.client = bigquery.Client(project=project)
+        self.dataset = f'{project}.{dataset}'
+
+    def table_fingerprint(self, table):
+        """The fingerprint `table` was last loaded with, or None."""
+        try:
+            labels = self.client.get_table(f'{self.dataset}.{table}').labels
+        except NotFound:
+            return None
+        return labels.get(FINGERPRINT_LABEL)
+
+    def _load(self, uris, table_id, schema):
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.AVRO,
+            use_avro_logical_types=True,
+            schema=schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        self.client.load_table_from_uri(uris, table_id,
+                                        job_config=job_config).result()
+
+    def load_avro(self, table, full_uri, delta_uris, schema,
+                  source_fingerprint, order_column=None):
+        """Replaces `table` with the full Avro file at `full_uri`, merges
+        in each delta file at `delta_uris` in turn, and waits. Returns the
+        table's row count.
+
+        Deltas need `order_column`, the watermark column they were fetched
+        by, to tell the newest copy of a row; see merge_query.
+        """
+        if delta_uris and order_column is None:
+            raise ValueError(f'{table}: no watermark column to order the '
+                             f'rows of its {len(delta_uris)} deltas by')
+
+        table_id = f'{self.dataset}.{table}'
+        self._load([full_uri], table_id, schema)
+
+        staging_id = f'{table_id}{STAGING_SUFFIX}'
+        try:
+            for uri in delta_uris:
+                self._load([uri], staging_id, schema)
+                self.client.query(merge_query(
+                    table_id, staging_id, schema, order_column)).result()
+        finally:
+            if delta_uris:
+                self.client.delete_table(staging_id, not_found_ok=True)
+
+        loaded = self.client.get_table(table_id)
+        loaded.labels = {**loaded.labels,
+                         FINGERPRINT_LABEL: source_fingerprint}
+        self.client.update_table(loaded, ['labels'])
+        return loaded.num_rows
+
+
+def load_tables(client, schemas, bucket_name, sources, max_jobs=8,
+                force=False, order_columns=None):
+    """Loads each entity of `sources` into its table, `max_jobs` tables
+    at a time.
+
+    `sources` maps an entity to the blobs of its Avro files in the bucket
+    `bucket_name`: the full file first, then its deltas in the order they
+    were written. `order_columns` maps an entity with deltas to its
+    watermark column. Tables already loaded from the same blobs are
+    skipped unless `force` is set. Returns the number of tables loaded,
+    or raises LoadError once the rest are loaded if any failed.
+    """
+    order_columns = order_columns or {}
+
+    def load(entity, blobs):
+        table = table_name(entity)
+        uris = [f'gs://{bucket_name}/{blob.name}' for blob in blobs]
+        source_fingerprint = fingerprint(blobs)
+        if (not force
+                and client.table_fingerprint(table) == source_fingerprint):
+            logger.info(f'BIGQUERY {table}: unchanged, skip')
+            return False
+
+        rows = client.load_avro(table, uris[0], uris[1:],
+                                to_bigquery_schema(schemas[entity]),
+                                source_fingerprint,
+                                order_columns.get(entity))
+        logger.info(f'BIGQUERY {table}: {rows} rows after loading '
+                    f'{len(uris)} files')
+        return True
+
+    loaded, failed = 0, []
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = {executor.submit(load, entity, blobs): entity
+                   for entity, blobs in sources.items()
+                   if entity in schemas}
+        for future in as_completed(futures):
+            try:
+                loaded += future.result()
+            except Exception:
+                logger.exception(f'BIGQUERY {futures[future]}: load failed')
+                failed.append(futures[future])
+    if failed:
+        raise LoadError(failed, loaded)
+    return loaded
@@ -1,22 +1,32 @@
 """
 Extracts data from batches of P223 PDFs from seattleschools.org.
 Reads PDFs from an input directory and writes CSVs to an output directory
-$ python3 p223_batch.py path/to/input/directory path/to/output/directory
+$ python3 p223_batch.py path/to/input/directory path/to/output/directory [--jobs N] [--backend pypdf]
+
+Parsed PDFs are cached by content hash (in output/cache by default), so re-runs only extract new or changed PDFs.
+all.csv is updated in place from the first changed month on, and each month is also written to
+output/avro/month=YYYY-MM/ for readers that only need some months.
+Text is extracted with pdftotext, or in-process with pypdf using --backend pypdf (see p223_pdf_text).
+With --columns, values are placed by their column in the layout text, and blank cells are left blank and flagged.
 
 The input directory should contain PDFs similar to https://www.seattleschools.org/wp-content/uploads/2024/09/P223_Sep24.pdf,
 and the PDF file names are expected to follow the naming convention to identify their month and year.
 """
 
+import argparse
 import glob
+import hashlib
+import json
 import os
 import re
 import pathlib
 import shutil
-import subprocess
-import sys
-import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastavro import parse_schema, writer
 
+import p223_pdf_text
 import p223_pdf_to_csv
 
 
@@ -36,64 +46,234 @@ def month_from_pdf_file_name(pdf_path) -> str:
     return month
 
 
-def main(input_directory, output_directory):
-    pdftotext = shutil.which('pdftotext2')
-    if pdftotext is None:
-        raise RuntimeError("'pdftotext' is not installed. See installation instructions in README.md.")
+def cache_version_directory(cache_directory) -> str:
+    return f'{cache_directory}/parser-v{p223_pdf_to_csv.PARSER_VERSION}'
 
-    tr = shutil.which('tr')
-    if tr is None:
-        raise RuntimeError("'tr' is not installed. See installation instructions in README.md.")
 
-    pdf_paths = glob.glob(f'{input_directory}/*.pdf')
+def evict_stale_cache(cache_directory):
+    """Deletes cached extractions made by other parser versions.
 
-    month_csv_paths = []
+    Only parser-vN directories are evicted; anything else in cache_directory is left alone.
+    """
+    if not os.path.isdir(cache_directory):
+        return
 
-    for pdf_path in pdf_paths:
-        with tempfile.NamedTemporaryFile(delete_on_close=False) as squished_tempfile:
-            # '-f 2' to start processing on the second page of the PDF (since page 1 is a cover page).
-            pdftotext_process = subprocess.Popen([pdftotext, '-layout', pdf_path, '-f', '2', '-'], stdout=squished_tempfile)
-            out, err = pdftotext_process.communicate()
+    current = os.path.basename(cache_version_directory(cache_directory))
+    for entry in os.listdir(cache_directory):
+        path = f'{cache_directory}/{entry}'
+        if entry != current and re.fullmatch(r'parser-v\d+', entry) and os.path.isdir(path):
+            print(f"Evicting stale extraction cache {path}")
+            shutil.rmtree(path)
 
-            if err is not None:
-                raise RuntimeError(f"'pdftotext' had an error:\n{err}")
 
-            if out is not None:
-                print(f"'pdftotext' produced output on stdout, which was unexpected:\n{out}")
+def pdf_hash(pdf_path) -> str:
+    with open(pdf_path, 'rb') as pdf_file:
+        return hashlib.file_digest(pdf_file, 'sha256').hexdigest()
 
-            squished_tempfile.close()
 
-            month = month_from_pdf_file_name(pdf_path)
-            month_csv_file_path = f'{output_directory}/month/{month}.csv'
-            pathlib.Path(os.path.dirname(month_csv_file_path)).mkdir(parents=True, exist_ok=True)
+def parse_pdf(backend_name, pdf_path, columns=False) -> list:
+    # The text is parsed as the backend extracts it, starting on page 2 (page 1 is a cover page).
+    iter_rows = p223_pdf_to_csv.iter_column_rows if columns else p223_pdf_to_csv.iter_rows
+    with p223_pdf_text.get_backend(backend_name).lines(pdf_path, first_page=2) as lines:
+        return list(iter_rows(lines))
 
-            p223_pdf_to_csv.main(squished_tempfile.name, month_csv_file_path, month)
 
-            print(f"Extracted {pdf_path} to {month_csv_file_path}")
+def blank_cells(rows) -> list:
+    """Describes the cells that --columns left blank in rows."""
+    return [f'{school}, grade {grade}: {header}'
+            for school, grade, *values in rows
+            for header, value in zip(p223_pdf_to_csv.HEADERS, values) if value is None]
 
-            month_csv_paths.append((month, month_csv_file_path))
 
-    month_csv_paths.sort(key=lambda month_and_path: month_and_path[0])
+# Avro sidecar schema. Avro field names can't contain spaces or dots, so the HEADERS are snake cased.
+AVRO_SCHEMA = parse_schema({
+    'name': 'P223Row',
+    'type': 'record',
+    'fields': [{'name': 'month', 'type': 'string'},
+               {'name': 'school', 'type': 'string'},
+               {'name': 'grade', 'type': 'string'}]
+              + [{'name': re.sub(r'\W+', '_', header).strip('_').lower(), 'type': ['null', 'double']}
+                 for header in p223_pdf_to_csv.HEADERS],
+})
+AVRO_FIELD_NAMES = [field['name'] for field in AVRO_SCHEMA['fields']]
+
+
+def write_avro(rows, avro_file_path, month):
+    records = (dict(zip(AVRO_FIELD_NAMES, (month, *row))) for row in rows)
+
+    pathlib.Path(os.path.dirname(avro_file_path)).mkdir(parents=True, exist_ok=True)
+    with open(f'{avro_file_path}.tmp', 'wb') as avro_file:
+        writer(avro_file, AVRO_SCHEMA, records, codec='deflate')
+    os.replace(f'{avro_file_path}.tmp', avro_file_path)
+
+
+def extract_pdf(backend_name, pdf_path, output_directory, cache_directory=None,
+                previous_key=None, columns=False) -> tuple[str, str, str, str, list]:
+    """
+    Extracts one PDF to output_directory/month/YYYY-MM.csv and output_directory/avro/month=YYYY-MM/.
+    Returns the month, the CSV path, what was done ('extracted', 'cached' or 'unchanged'),
+    the key (content hash, parser version, text backend and parse mode) of the month's data
+    and its blank cells (see blank_cells), unless unchanged.
+    Runs in a worker process when extracting with --jobs.
+    """
+    month = month_from_pdf_file_name(pdf_path)
+    month_csv_file_path = f'{output_directory}/month/{month}.csv'
+    avro_file_path = f'{output_directory}/avro/month={month}/{month}.avro'
+    pathlib.Path(os.path.dirname(month_csv_file_path)).mkdir(parents=True, exist_ok=True)
+
+    content_hash = pdf_hash(pdf_path)
+    method = f'{backend_name}+columns' if columns else backend_name
+    key = f'{content_hash}/v{p223_pdf_to_csv.PARSER_VERSION}/{method}'
+    if key == previous_key and os.path.exists(month_csv_file_path) and os.path.exists(avro_file_path):
+        return month, month_csv_file_path, 'unchanged', key, []
+
+    rows = None
+    cache_path = None
+    if cache_directory:
+        cache_path = f'{cache_version_directory(cache_directory)}/{content_hash}.{method}.json'
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as cache_file:
+                rows = json.load(cache_file)
+
+    status = 'cached' if rows is not None else 'extracted'
+    if rows is None:
+        rows = parse_pdf(backend_name, pdf_path, columns)
+
+        if cache_path:
+            pathlib.Path(os.path.dirname(cache_path)).mkdir(parents=True, exist_ok=True)
+            with open(f'{cache_path}.tmp', 'w', encoding='utf-8') as cache_file:
+                json.dump(rows, cache_file)
+            os.replace(f'{cache_path}.tmp', cache_path)
+
+    with open(month_csv_file_path, 'w', newline='') as month_csv_file:
+        p223_pdf_to_csv.write_csv(rows, month_csv_file, month)
+    write_avro(rows, avro_file_path, month)
+
+    return month, month_csv_file_path, status, key, blank_cells(rows)
+
+
+def read_manifest(all_csv_path) -> list:
+    """
+    Returns the segments of all.csv recorded by update_all_csv, or [] if there is no manifest or
+    all.csv no longer matches it.
+    """
+    manifest_path = f'{all_csv_path}.manifest.json'
+    if not os.path.exists(manifest_path) or not os.path.exists(all_csv_path):
+        return []
+
+    with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+        segments = json.load(manifest_file)['segments']
+
+    if not segments or os.path.getsize(all_csv_path) != segments[-1]['end']:
+        return []
+    return segments
 
-    # Concatenate all the CSVs into one.
-    all_csv_path = f'{output_directory}/all.csv'
-    pathlib.Path(os.path.dirname(all_csv_path)).mkdir(parents=True, exist_ok=True)
 
-    with open(all_csv_path, 'w') as all_csv:
-        first_month_csv = True
+def update_all_csv(all_csv_path, month_csvs, segments):
+    """
+    Brings all.csv up to date with month_csvs, a list of (month, key, month CSV path) sorted by
+    month, given the segments it was last built from. Months before the first new or changed one
+    are kept as they are; that month and everything after it are rewritten, so adding the latest
+    month only appends it.
+    """
+    keep = 0
+    while (keep < min(len(segments), len(month_csvs))
+           and [segments[keep]['month'], segments[keep]['key']] == list(month_csvs[keep][:2])):
+        keep += 1
 
-        for (_, month_csv_file_path) in month_csv_paths:
-            with open(month_csv_file_path, 'r', encoding='utf-8') as month_csv_file:
+    if keep == len(segments) == len(month_csvs):
+        print(f"{all_csv_path} is up to date")
+        return
+
+    segments = segments[:keep]
+    offset = segments[-1]['end'] if segments else 0
+    with open(all_csv_path, 'r+b' if segments else 'wb') as all_csv:
+        all_csv.truncate(offset)
+        all_csv.seek(offset)
+
+        # Lines are copied with '\n' endings, as when all.csv was written in text mode.
+        for (month, key, month_csv_file_path) in month_csvs[keep:]:
+            with open(month_csv_file_path, 'rb') as month_csv_file:
                 header_line = month_csv_file.readline()
-                if first_month_csv:
-                    all_csv.write(header_line)
-                    first_month_csv = False
+                if all_csv.tell() == 0:
+                    all_csv.write(header_line.rstrip(b'\r\n') + b'\n')
 
                 for data_line in month_csv_file:
-                    all_csv.write(data_line)
+                    all_csv.write(data_line.rstrip(b'\r\n') + b'\n')
+
+            segments.append({'month': month, 'key': key, 'end': all_csv.tell()})
+
+    with open(f'{all_csv_path}.manifest.json', 'w', encoding='utf-8') as manifest_file:
+        json.dump({'segments': segments}, manifest_file, indent=1)
+
+    print(f"Rewrote {len(month_csvs) - keep} of {len(month_csvs)} months of {all_csv_path}")
 
-    print(f"Concatenated all extracted CSVs to {all_csv_path}")
+
+def main(input_directory, output_directory, jobs=1, cache_directory=None, backend_name='pdftotext',
+         columns=False):
+    # Fails early if the backend is not installed. Each worker process makes its own instance.
+    p223_pdf_text.get_backend(backend_name)
+
+    # Sorted so that runs are reproducible whatever order the directory lists in.
+    pdf_paths = sorted(glob.glob(f'{input_directory}/*.pdf'))
+
+    if cache_directory:
+        evict_stale_cache(cache_directory)
+
+    all_csv_path = f'{output_directory}/all.csv'
+    segments = read_manifest(all_csv_path)
+    previous_keys = {segment['month']: segment['key'] for segment in segments}
+
+    month_csvs = []
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # map() yields results in the order of pdf_paths, however the workers finish.
+        results = executor.map(extract_pdf,
+                               [backend_name] * len(pdf_paths),
+                               pdf_paths,
+                               [output_directory] * len(pdf_paths),
+                               [cache_directory] * len(pdf_paths),
+                               [previous_keys.get(month_from_pdf_file_name(pdf_path)) for pdf_path in pdf_paths],
+                               [columns] * len(pdf_paths))
+        for pdf_path, (month, month_csv_file_path, status, key, blanks) in zip(pdf_paths, results):
+            if status == 'unchanged':
+                print(f"Unchanged {pdf_path}")
+            elif status == 'cached':
+                print(f"Wrote cached rows of {pdf_path} to {month_csv_file_path}")
+            else:
+                print(f"Extracted {pdf_path} to {month_csv_file_path}")
+
+            if blanks:
+                print(f"Flagged {len(blanks)} blank cells in {pdf_path}:")
+                for blank in blanks:
+                    print(f"  {blank}")
+
+            month_csvs.append((month, key, month_csv_file_path))
+
+    month_csvs.sort(key=lambda month_csv: month_csv[0])
+
+    # Concatenate all the CSVs into one, reusing what is still current.
+    pathlib.Path(os.path.dirname(all_csv_path)).mkdir(parents=True, exist_ok=True)
+    update_all_csv(all_csv_path, month_csvs, segments)
 
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser(description='Extracts data from batches of P223 PDFs.')
+    parser.add_argument('input_directory')
+    parser.add_argument('output_directory')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='Number of PDFs to extract in parallel (default: %(default)s)')
+    parser.add_argument('--cache-directory',
+                        help='Where to cache parsed PDFs by content hash (default: OUTPUT_DIRECTORY/cache). '
+                             'Pass an empty string to disable the cache.')
+    parser.add_argument('--backend', choices=sorted(p223_pdf_text.BACKENDS), default='pdftotext',
+                        help='How to extract the text of the PDFs (default: %(default)s)')
+    parser.add_argument('--columns', action='store_true',
+                        help='Place values by their column in the layout text, leaving and flagging blank cells '
+                             'rather than shifting the values after them')
+    args = parser.parse_args()
+
+    if args.cache_directory is None:
+        args.cache_directory = f'{args.output_directory}/cache'
+
+    main(args.input_directory, args.output_directory, args.jobs, args.cache_directory, args.backend, args.columns)
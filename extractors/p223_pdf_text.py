@@ -0,0 +1,88 @@
+"""
+Backends that pull layout-preserving text out of P223 PDFs, for p223_pdf_to_csv.iter_rows.
+$ python3 p223_pdf_text.py [--backend pypdf] p223_sep24.pdf > p223_sep24.txt
+
+  pdftotext  runs `pdftotext -layout` in a subprocess (needs poppler, see README.md).
+  pypdf      extracts the text in-process with the pure-Python pypdf library (`pip install 'pypdf>=4'`,
+             for its layout mode), so there is no process to spawn per PDF. Its layout text has not
+             been checked against pdftotext's on real P223 PDFs, so the columns may differ.
+
+Both skip page 1, the cover page. Backends hold no per-PDF state, so one instance can serve every
+PDF a long-lived worker process extracts; get_backend returns that instance.
+"""
+
+import argparse
+import functools
+import shutil
+import subprocess
+import sys
+from contextlib import contextmanager
+
+
+class PdftotextBackend:
+    name = 'pdftotext'
+
+    def __init__(self):
+        self.pdftotext = shutil.which('pdftotext')
+        if self.pdftotext is None:
+            raise RuntimeError("'pdftotext' is not installed. See installation instructions in README.md.")
+
+    @contextmanager
+    def lines(self, pdf_path, first_page=2):
+        """Yields the text lines of pdf_path from first_page on, as pdftotext writes them."""
+        with subprocess.Popen([self.pdftotext, '-layout', pdf_path, '-f', str(first_page), '-'],
+                              stdout=subprocess.PIPE, encoding='utf-8') as pdftotext_process:
+            yield pdftotext_process.stdout
+
+        if pdftotext_process.returncode != 0:
+            raise RuntimeError(f"'pdftotext' failed on {pdf_path} with exit status {pdftotext_process.returncode}")
+
+
+class PypdfBackend:
+    name = 'pypdf'
+
+    def __init__(self):
+        try:
+            import pypdf
+        except ImportError:
+            raise RuntimeError("'pypdf' is not installed. See installation instructions in README.md.")
+        self.pypdf = pypdf
+
+    @contextmanager
+    def lines(self, pdf_path, first_page=2):
+        """Yields the text lines of pdf_path from first_page on, extracted page by page in layout mode."""
+        reader = self.pypdf.PdfReader(pdf_path)
+        try:
+            yield self.page_lines(reader.pages[first_page - 1:])
+        finally:
+            reader.close()
+
+    def page_lines(self, pages):
+        for page in pages:
+            # A form feed line between pages, like pdftotext's page breaks.
+            yield '\f'
+            yield from page.extract_text(extraction_mode='layout').splitlines()
+
+
+BACKENDS = {backend.name: backend for backend in [PdftotextBackend, PypdfBackend]}
+
+
+@functools.cache
+def get_backend(name):
+    """Returns this process's instance of the backend called name."""
+    return BACKENDS[name]()
+
+
+def main(pdf_path, backend_name):
+    with get_backend(backend_name).lines(pdf_path) as lines:
+        for line in lines:
+            sys.stdout.write(line.rstrip('\n') + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prints the text of a P223 PDF, skipping the cover page.')
+    parser.add_argument('pdf_path')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='pdftotext')
+    args = parser.parse_args()
+
+    main(args.pdf_path, args.backend)
@@ -3,15 +3,22 @@ Hacky ps223 pdf to csv converter.
 $ curl \
     https://www.seattleschools.org/wp-content/uploads/2024/09/P223_Sep24.pdf \
     -o p223_sep24.pdf
-$ pdftotext -layout p223_sep24.pdf -f 2 - > squished.txt
-$ python3 p223_pdf_to_csv.py squished.txt out.csv
+$ pdftotext -layout p223_sep24.pdf -f 2 - > p223_sep24.txt
+$ python3 p223_pdf_to_csv.py p223_sep24.txt out.csv
+
+With --columns, each value is placed by its column in the layout text (which must not have been squished
+with `tr -s ' '`), so blank cells stay blank rather than shifting the values after them:
+$ python3 p223_pdf_to_csv.py --columns p223_sep24.txt out.csv
 """
 
-import re
+import argparse
+import collections
 import csv
-import sys
+import re
+
+# Bump whenever a change to parsing changes its output (or the rows it caches), so cached extractions are redone.
+PARSER_VERSION = 3
 
-SCHOOL_PREFIX = 'School: '
 HEADERS = [
     "Regular Program",
     "Bilingual Served",
@@ -24,65 +31,213 @@ HEADERS = [
     "P223 Total FTE",
 ]
 
-PRESCHOOL_LINE = 'Gr: Preschool'
-STATE_FDK_LINE = ' State FDK'
-STATE_FDK_EQUALS_LINE = ' State FDK ='
-K_12_LINE_REGEX = re.compile('^ ([1-9K][0-2]?)')
-
-
-def get_grade(line):
-    if line.startswith(PRESCHOOL_LINE):
-        return 'Preschool', line[len(PRESCHOOL_LINE):].strip()
-
-    grade = None
-    if line.startswith(STATE_FDK_LINE) and not line.startswith(STATE_FDK_EQUALS_LINE):
-        return 'K', line[len(STATE_FDK_LINE):].strip()
-
-    m = K_12_LINE_REGEX.match(line)
-    if m:
-        grade = m.group(1)
-        return grade, line[len(grade) + 1:].strip()
+# The first character of a K-12 grade line, whose grade is that character and, for 10-12, the next.
+GRADE_FIRST_CHARACTERS = frozenset('123456789K')
+GRADE_SECOND_CHARACTERS = frozenset('012')
+TOKEN_REGEX = re.compile(r'\S+')
+
+
+def school_rows(school, grades):
+    for grade, values in grades.items():
+        yield (school, grade) + values
+
+
+def classify_line(line):
+    """
+    Classifies a line of pdftotext output, split on whitespace once, by its first tokens:
+      'School: <name>'          starts a school; returns (None, name)
+      'Gr: Preschool <values>'  the Preschool row; returns ('Preschool', value tokens)
+      '  State FDK <values>'    the K row (but not '  State FDK = ...'); returns ('K', value tokens)
+      '  <grade> <values>'      a K-12 row, for a grade of K, 1-9 or 10-12; returns (grade, value tokens)
+    Returns None for anything else. A leading form feed, which pdftotext puts at the start of the
+    first line of each page after the first, is not part of the line.
+    """
+    line = line.lstrip('\f')
+    tokens = line.split()
+    if not tokens:
+        return None
+
+    first = tokens[0]
+    if not line[0].isspace():
+        if first == 'School:':
+            return None, ' '.join(tokens[1:])
+        if first == 'Gr:' and len(tokens) > 2 and tokens[1] == 'Preschool':
+            return 'Preschool', tokens[2:]
+        return None
+    if first == 'State':
+        if len(tokens) > 2 and tokens[1] == 'FDK' and not tokens[2].startswith('='):
+            return 'K', tokens[2:]
+        return None
+    if first[0] in GRADE_FIRST_CHARACTERS:
+        grade = first[:2] if len(first) > 1 and first[1] in GRADE_SECOND_CHARACTERS else first[0]
+        values = tokens[1:]
+        if len(first) > len(grade):
+            values.insert(0, first[len(grade):])
+        if values:
+            return grade, values
+    return None
+
+
+def iter_rows(lines):
+    """
+    Parses pdftotext output into rows of (school, grade, *values), one school at a time.
+    lines can be any iterable of text lines, e.g. an open file or a pipe from pdftotext.
+    The values of a row are its numbers in order, wherever they are on the line; see
+    iter_column_rows to place them by column instead.
+
+    See classify_line for the lines that are parsed; anything else is skipped. A later row for the
+    same grade of a school replaces the earlier one.
+    """
+    school = None
+    grades = {}
+    for line in lines:
+        classified = classify_line(line)
+        if classified is None:
+            continue
+
+        grade, values = classified
+        if grade is None:
+            if school is not None:
+                yield from school_rows(school, grades)
+            school = values
+            grades = {}
+            continue
+
+        if school is None:
+            raise ValueError(f"Grade line before any 'School:' line: {line!r}")
+        grades[grade] = tuple(map(float, values))
+
+    if school is not None:
+        yield from school_rows(school, grades)
+
+
+def column_positions(page):
+    """
+    Maps where a value can end on a page of grade lines, as (grade, line, value spans), to its
+    HEADERS column. Numbers are right-aligned in their columns, so the right edge of each column is
+    where its values most often end among the rows with a value in every column, and a value belongs
+    to the column whose edge is less than half the narrowest column away.
+    Returns None if no row has a value in every column.
+    """
+    ends = [collections.Counter() for _ in HEADERS]
+    for _, _, spans in page:
+        if len(spans) == len(HEADERS):
+            for column_ends, (_, end) in zip(ends, spans):
+                column_ends[end] += 1
+
+    if not ends[0]:
+        return None
+    edges = [column_ends.most_common(1)[0][0] for column_ends in ends]
+    reach = (min(b - a for a, b in zip(edges, edges[1:])) - 1) // 2
+    return {end: column for column, edge in enumerate(edges) for end in range(edge - reach, edge + reach + 1)}
+
+
+def place_values(school, grade, line, spans, positions):
+    """Places each value on line under its column (see column_positions); blank columns get None."""
+    values = [None] * len(HEADERS)
+    for start, end in spans:
+        column = positions.get(end)
+        if column is None or values[column] is not None:
+            raise ValueError(f"{school}, grade {grade}: {line[start:end]!r} is not under a column of its own: {line!r}")
+        values[column] = float(line[start:end])
+    return tuple(values)
+
+
+def iter_column_rows(lines):
+    """
+    Parses `pdftotext -layout` output, as it is and not squished, like iter_rows, but places each
+    value under its HEADERS column by where it is on the line. A blank cell is None instead of
+    shifting the values after it a column to the left, and a value that is not under any column
+    raises ValueError.
+
+    The column positions are found for each page (pages start with a form feed) from the rows on it
+    with a value in every column, or else carried over from the previous page.
+    """
+    school = None
+    grades = {}
+    positions = None
+    # The (grade, line, value spans) of each grade line on the page so far, and (None, name, None) of each school.
+    page = []
+
+    def end_page():
+        nonlocal school, grades, positions
+        positions = column_positions(item for item in page if item[0] is not None) or positions
+        for grade, line, spans in page:
+            if grade is None:
+                if school is not None:
+                    yield from school_rows(school, grades)
+                school = line
+                grades = {}
+                continue
+
+            if school is None:
+                raise ValueError(f"Grade line before any 'School:' line: {line!r}")
+            if positions is None:
+                raise ValueError(f"No row with a value in every column to find the columns from: {line!r}")
+            grades[grade] = place_values(school, grade, line, spans, positions)
+        page.clear()
+
+    for line in lines:
+        if line.startswith('\f'):
+            yield from end_page()
+            # The form feed is not part of the layout.
+            line = line.lstrip('\f')
+
+        classified = classify_line(line)
+        if classified is None:
+            continue
+
+        grade, values = classified
+        if grade is None:
+            page.append((None, values, None))
+        else:
+            # The values are the last tokens of the line.
+            spans = [match.span() for match in TOKEN_REGEX.finditer(line)][-len(values):]
+            page.append((grade, line, spans))
+
+    yield from end_page()
+    if school is not None:
+        yield from school_rows(school, grades)
+
+
+def write_csv(rows, outfile, month=None):
+    """Writes rows from iter_rows to outfile as CSV, with a leading Month column if month is given."""
+    writer = csv.writer(outfile)
+
+    header_row = []
+    if month is not None:
+        header_row.append('Month')
+
+    header_row.extend(['School', 'Grade'] + HEADERS)
+    writer.writerow(header_row)
+
+    if month is None:
+        writer.writerows(rows)
     else:
-        return None, None
-
-
-def parse_line(line, school):
-    grade, remaining = get_grade(line)
-    if grade and remaining:
-        school[grade] = [float(x) for x in remaining.split(' ')]
+        writer.writerows((month, *row) for row in rows)
 
 
-def main(filename, csvname, month=None):
-    p233_data = {}
-    school = None
-    with open(filename, "r", encoding="utf-8") as infile:
-        for line in infile:
-            line = re.sub(r'\s+', ' ', line)
-            if line.startswith(SCHOOL_PREFIX):
-                school = {}
-                p233_data[line[len(SCHOOL_PREFIX):].strip()] = school
-            else:
-                parse_line(line, school)
-
+def convert(lines, csvname, month=None, columns=False):
+    """
+    Parses lines of pdftotext output and writes them to the CSV file csvname as they are parsed,
+    with iter_column_rows if columns is set or else iter_rows.
+    """
+    rows = iter_column_rows(lines) if columns else iter_rows(lines)
     with open(csvname, 'w', newline='') as outfile:
-        writer = csv.writer(outfile)
-
-        header_row = []
-        if month is not None:
-            header_row.append('Month')
+        write_csv(rows, outfile, month)
 
-        header_row.extend(['School', 'Grade'] + HEADERS)
-        writer.writerow(header_row)
 
-        for school, gradeinfo in p233_data.items():
-            for grade, data in gradeinfo.items():
-                data_row = []
-                if month is not None:
-                    data_row.append(month)
-
-                data_row.extend([school, grade] + data)
-                writer.writerow(data_row)
+def main(filename, csvname, month=None, columns=False):
+    with open(filename, "r", encoding="utf-8") as infile:
+        convert(infile, csvname, month, columns)
 
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser(description='Converts the text of a P223 PDF to CSV.')
+    parser.add_argument('filename')
+    parser.add_argument('csvname')
+    parser.add_argument('--columns', action='store_true',
+                        help='Place values by their column in unsquished `pdftotext -layout` text, leaving blank cells empty')
+    args = parser.parse_args()
+
+    main(args.filename, args.csvname, columns=args.columns)
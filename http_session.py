@@ -0,0 +1,184 @@
+"""
+Pooled, keep-alive HTTP client for talking to the OData endpoint.
+
+Connections are reused across pages (and across worker threads), responses
+are gzip encoded, and 429/5xx responses are retried with exponential
+backoff that honors Retry-After.
+"""
+
+import asyncio
+import contextlib
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HttpStats:
+    """Process wide request, connection and retry counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.retries = 0
+
+    def add(self, requests=0, connections=0, retries=0):
+        with self.lock:
+            self.requests += requests
+            self.connections += connections
+            self.retries += retries
+
+    def as_dict(self):
+        with self.lock:
+            return {'requests': self.requests,
+                    'connections': self.connections,
+                    'retries': self.retries}
+
+
+stats = HttpStats()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        stats.add(connections=1)
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        stats.add(connections=1)
+        return super()._new_conn()
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter that counts every new TCP (+TLS) connection."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+
+class HttpClient:
+    """Thread-safe GETs over a shared pooled session.
+
+    Each response's `retries` is the number of times it was retried.
+    """
+
+    def __init__(self, pool_size=10, retries=5, backoff_factor=1.0,
+                 connect_timeout=10.0, read_timeout=120.0):
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUSES,
+                      allowed_methods=['GET'],
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = _CountingAdapter(pool_connections=pool_size,
+                                   pool_maxsize=pool_size,
+                                   max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+
+    def get(self, url, **kwargs):
+        response = self.session.get(url, timeout=self.timeout, **kwargs)
+        retries = response.raw.retries
+        response.retries = len(retries.history) if retries else 0
+        stats.add(requests=1, retries=response.retries)
+        return response
+
+
+def _backoff_seconds(attempt, backoff_factor, retry_after):
+    """Seconds to sleep before retry `attempt`, preferring Retry-After."""
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp()
+                           - time.time())
+            except (TypeError, ValueError):
+                pass
+    return backoff_factor * (2 ** attempt)
+
+
+class AsyncHttpClient:
+    """asyncio counterpart of HttpClient, built on aiohttp.
+
+    Use as an async context manager; get() returns (status, body bytes).
+    """
+
+    def __init__(self, pool_size=10, retries=5, backoff_factor=1.0,
+                 connect_timeout=10.0, read_timeout=120.0):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self.session = None
+
+    async def __aenter__(self):
+        async def on_connection(session, context, params):
+            stats.add(connections=1)
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(on_connection)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=self.timeout,
+            trace_configs=[trace])
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    async def get(self, url):
+        async with self.stream(url) as response:
+            return response.status, await response.read()
+
+    @contextlib.asynccontextmanager
+    async def stream(self, url):
+        """Yields the aiohttp response for `url` with its body unread,
+        once it has a status that isn't retried (or retries run out). Its
+        `retries` is the number of times it was retried.
+        """
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                response = await self.session.get(url)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    stats.add(requests=1, retries=attempt)
+                    raise
+            else:
+                if (response.status not in RETRY_STATUSES
+                        or attempt >= self.retries):
+                    break
+                retry_after = response.headers.get('Retry-After')
+                response.release()
+
+            await asyncio.sleep(
+                _backoff_seconds(attempt, self.backoff_factor, retry_after))
+            attempt += 1
+
+        stats.add(requests=1, retries=attempt)
+        response.retries = attempt
+        try:
+            yield response
+        finally:
+            response.release()
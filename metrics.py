@@ -0,0 +1,329 @@
+"""
+Throughput and latency metrics for a crawl.
+
+The fetch stage attaches the timings of each page, or chunk of a page, to
+it under PAGE_METRICS, and the transform and encode stages add theirs as
+the page passes through. EntityMetrics sums them per page and per entity
+along with upload time, and RunReport writes the sums as JSON lines and,
+optionally, as a Prometheus text-format file. ThreadProfiles runs cProfile
+in the threads of a crawl, for --profile.
+"""
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+from odata_json import PARTIAL_PAGE, ReadWrapper
+
+logger = logging.getLogger(__name__)
+
+# Key of the metrics dict carried by a page (or chunk) on its way through
+# the pipeline.
+PAGE_METRICS = '@metrics'
+
+STAGES = ('fetch', 'parse', 'transform', 'encode', 'upload')
+
+
+def add_page_metrics(data, **metrics):
+    """Adds `metrics` (seconds, body bytes, retries) to those of page
+    `data`.
+    """
+    page_metrics = data.setdefault(PAGE_METRICS, {})
+    for name, value in metrics.items():
+        page_metrics[name] = page_metrics.get(name, 0) + value
+
+
+class TimedReader(ReadWrapper):
+    """File wrapper that counts the bytes read through it and the seconds
+    spent waiting on read().
+    """
+
+    def __init__(self, fileobj, is_async=False):
+        super().__init__(fileobj, is_async)
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def seen(self, data, started):
+        self.seconds += time.perf_counter() - started
+        self.bytes += len(data)
+        return data
+
+
+class EntityMetrics:
+    """Per-page and total metrics of one entity, reported to `report`."""
+
+    def __init__(self, entity, report=None):
+        self.entity = entity
+        self.report = report
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.pages = 0
+        self.rows = 0
+        self.body_bytes = 0
+        self.retries = 0
+        self.latency_seconds = []
+        self.page = {}
+
+    @contextmanager
+    def timed(self, stage):
+        """Adds the time spent in the block to the entity's `stage`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.seconds[stage] += time.perf_counter() - start
+
+    def page_done(self, data, rows):
+        """Adds `rows` written from `data`, a page or a chunk of one, and
+        the metrics it carries. Reports the page once its last chunk is in.
+        """
+        with self.lock:
+            self.rows += rows
+            page = self.page
+            page['rows'] = page.get('rows', 0) + rows
+            for name, value in data.get(PAGE_METRICS, {}).items():
+                page[name] = page.get(name, 0) + value
+            if data.get(PARTIAL_PAGE):
+                return
+
+            self.pages += 1
+            self.page = {}
+            self.body_bytes += page.get('body_bytes', 0)
+            self.retries += page.get('retries', 0)
+            if 'latency_seconds' in page:
+                self.latency_seconds.append(page['latency_seconds'])
+            for stage in STAGES:
+                self.seconds[stage] += page.get(f'{stage}_seconds', 0.0)
+
+        if self.report is not None:
+            self.report.write({'type': 'page', 'entity': self.entity,
+                               'page': self.pages,
+                               **{name: round(value, 6)
+                                  for name, value in page.items()}})
+
+    def as_dict(self):
+        with self.lock:
+            wall_seconds = time.monotonic() - self.started
+            latency = self.latency_seconds
+            return {
+                'entity': self.entity,
+                'pages': self.pages,
+                'rows': self.rows,
+                'body_bytes': self.body_bytes,
+                'retries': self.retries,
+                'wall_seconds': round(wall_seconds, 3),
+                'rows_per_second': round(self.rows / wall_seconds, 1)
+                if wall_seconds else 0.0,
+                'latency_seconds_mean': round(sum(latency) / len(latency), 4)
+                if latency else None,
+                'latency_seconds_max': round(max(latency), 4)
+                if latency else None,
+                **{f'{stage}_seconds': round(seconds, 4)
+                   for stage, seconds in self.seconds.items()},
+            }
+
+    def done(self, status):
+        """Logs the entity's totals and reports them with `status`."""
+        totals = self.as_dict()
+        totals['status'] = status
+        logger.info(f'METRICS {self.entity}: {totals}')
+        if self.report is not None:
+            self.report.entity_done(totals)
+
+
+def _prometheus_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+# Prometheus metric name, help and the entity totals key it is read from.
+PROMETHEUS_METRICS = [
+    ('ospi_entity_pages', 'Pages fetched', 'pages'),
+    ('ospi_entity_rows', 'Rows written', 'rows'),
+    # Counted after gzip decoding, not as transferred: aiohttp gives no
+    # count of the bytes on the wire.
+    ('ospi_entity_body_bytes', 'Response body bytes read, after gzip '
+     'decoding,', 'body_bytes'),
+    ('ospi_entity_retries', 'HTTP retries', 'retries'),
+    ('ospi_entity_wall_seconds', 'Seconds from start to finish',
+     'wall_seconds'),
+    ('ospi_entity_rows_per_second', 'Rows written per wall second',
+     'rows_per_second'),
+    ('ospi_entity_latency_seconds_max', 'Slowest time to a page response',
+     'latency_seconds_max'),
+]
+
+
+class RunReport:
+    """Writes page and entity metrics as JSON lines to `path` as they come
+    in, and on close() the entity totals in the Prometheus text format to
+    `prometheus_path` (for node_exporter's textfile collector, say).
+    Either may be None.
+    """
+
+    def __init__(self, path=None, prometheus_path=None):
+        self.lock = threading.Lock()
+        self.file = open(path, 'w', encoding='utf-8') if path else None
+        self.prometheus_path = prometheus_path
+        self.entities = []
+
+    def write(self, record):
+        if self.file is None:
+            return
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def entity_done(self, totals):
+        with self.lock:
+            self.entities.append(totals)
+        self.write({'type': 'entity', **totals})
+
+    def close(self, **run):
+        """Reports the run's totals plus `run` and closes the report."""
+        with self.lock:
+            entities = list(self.entities)
+        self.write({'type': 'run', 'entities': len(entities),
+                    'rows': sum(totals['rows'] for totals in entities),
+                    'body_bytes': sum(totals['body_bytes']
+                                      for totals in entities),
+                    **run})
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.prometheus_path:
+            self.write_prometheus(entities)
+
+    def write_prometheus(self, entities):
+        lines = []
+        for name, help_text, key in PROMETHEUS_METRICS:
+            lines.append(f'# HELP {name} {help_text} per entity set.')
+            lines.append(f'# TYPE {name} gauge')
+            for totals in entities:
+                if totals[key] is not None:
+                    lines.append(f'{name}{{entity="'
+                                 f'{_prometheus_label(totals["entity"])}"}} '
+                                 f'{totals[key]}')
+
+        name = 'ospi_entity_stage_seconds'
+        lines.append(f'# HELP {name} Seconds spent in each stage per entity '
+                     f'set.')
+        lines.append(f'# TYPE {name} gauge')
+        for totals in entities:
+            entity = _prometheus_label(totals['entity'])
+            for stage in STAGES:
+                lines.append(f'{name}{{entity="{entity}",stage="{stage}"}} '
+                             f'{totals[f"{stage}_seconds"]}')
+
+        # Written whole and renamed, so collectors never see a partial file.
+        with open(f'{self.prometheus_path}.tmp', 'w',
+                  encoding='utf-8') as prometheus_file:
+            prometheus_file.write('\n'.join(lines) + '\n')
+        os.replace(f'{self.prometheus_path}.tmp', self.prometheus_path)
+
+
+class _ChunkMeter:
+    """Splits the time between chunks parsed from TimedReader `reader`
+    into the seconds spent waiting on reads, its fetch seconds, and the
+    rest, its parse seconds. The response's latency and retries go on the
+    first chunk.
+    """
+
+    def __init__(self, reader, latency_seconds, retries):
+        self.reader = reader
+        self.first = {'latency_seconds': latency_seconds, 'retries': retries}
+        self.latency_seconds = latency_seconds
+        self.seconds, self.bytes = 0.0, 0
+        self.resume()
+
+    def resume(self):
+        """Starts timing the next chunk."""
+        self.mark = time.perf_counter()
+
+    def measure(self, data):
+        """Adds the metrics of chunk `data`, parsed since resume()."""
+        reader = self.reader
+        waited = reader.seconds - self.seconds
+        add_page_metrics(
+            data, fetch_seconds=waited + self.latency_seconds,
+            parse_seconds=time.perf_counter() - self.mark - waited,
+            body_bytes=reader.bytes - self.bytes, **self.first)
+        self.first = {}
+        self.latency_seconds = 0.0
+        self.seconds, self.bytes = reader.seconds, reader.bytes
+        return data
+
+
+def measure_chunks(chunks, reader, latency_seconds, retries):
+    """Yields each of `chunks`, as parsed from TimedReader `reader`, with
+    its metrics added; see _ChunkMeter.
+    """
+    meter = _ChunkMeter(reader, latency_seconds, retries)
+    for data in chunks:
+        yield meter.measure(data)
+        meter.resume()
+
+
+async def ameasure_chunks(chunks, reader, latency_seconds, retries):
+    """measure_chunks over async `chunks`."""
+    meter = _ChunkMeter(reader, latency_seconds, retries)
+    async for data in chunks:
+        yield meter.measure(data)
+        meter.resume()
+
+
+class ThreadProfiles:
+    """cProfile profiles of the threads that ran under profiled() while
+    `enabled`, combined by write().
+
+    Since Python 3.12 cProfile sits on sys.monitoring, which allows one
+    active profiler per process, so threads must not overlap in profiled().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.profiles = []
+
+    @contextmanager
+    def profiled(self):
+        """Profiles the calling thread for the block, if enabled."""
+        if not self.enabled:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                self.profiles.append(profile)
+
+    def write(self, path, top=30):
+        """Saves the combined profile to `path`, for pstats or snakeviz, and
+        returns its `top` functions by cumulative time as text.
+        """
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return 'no profiles'
+
+        text = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=text)
+        stats.dump_stats(path)
+        stats.sort_stats('cumulative').print_stats(top)
+        return text.getvalue()
+
+
+profiles = ThreadProfiles()
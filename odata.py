@@ -1,12 +1,31 @@
 import copy
 import functools
-from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import xml.etree.ElementTree as ET
+from array import array
+from datetime import date, datetime, timedelta, timezone
+from itertools import chain
 
 ODATA_NS = {'edmx': 'http://docs.oasis-open.org/odata/ns/edmx',
             'edm': 'http://docs.oasis-open.org/odata/ns/edm'}
 
 SOCRATA_PREFIX = 'socrata.'
 EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+# Distinct date strings remembered by the date transforms. OSPI tables
+# repeat a few thousand dates across millions of rows.
+DATE_CACHE_SIZE = 65536
+
+# The shape Socrata uses for dates and timestamps, e.g.
+# 2024-09-01T00:00:00.000Z. Anything else takes the fromisoformat path.
+ISO_UTC_REGEX = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{3}))?Z', re.ASCII)
 
 
 def identity(x):
@@ -36,89 +55,272 @@ def transform_complex_field(field, value):
     return transform(value[name])
 
 
+def _parse_iso_utc(x):
+    """Returns (days, millis into the day) since the epoch for the common
+    fixed-format UTC shape, or None if `x` isn't in that shape.
+    """
+    m = ISO_UTC_REGEX.fullmatch(x)
+    if m is None:
+        return None
+
+    year, month, day, hour, minute, second, millis = m.groups()
+    hour, minute, second = int(hour), int(minute), int(second)
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    try:
+        days = date(int(year), int(month), int(day)).toordinal()
+    except ValueError:
+        return None
+
+    return (days - EPOCH_ORDINAL,
+            ((hour * 60 + minute) * 60 + second) * 1000 + int(millis or 0))
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _epoch_days(x):
+    parsed = _parse_iso_utc(x)
+    if parsed is None:
+        return _since_epoch(x).days
+    return parsed[0]
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def _epoch_millis(x):
+    parsed = _parse_iso_utc(x)
+    if parsed is None:
+        return round(_since_epoch(x) / timedelta(milliseconds=1))
+    return parsed[0] * 86400000 + parsed[1]
+
+
 def transform_edm_date_to_epoch_days(x):
     if x is None:
         return x
 
-    return _since_epoch(x).days
+    return _epoch_days(x)
 
 
 def transform_edm_date_to_millis(x):
     if x is None:
         return x
 
-    return round(_since_epoch(x) / timedelta(milliseconds=1))
+    return _epoch_millis(x)
 
 
-def transform_edm_point_to_pointliteral(x):
-    if x is None:
-        return x
+def _batch(convert):
+    def convert_column(values):
+        converted = {value: convert(value) for value in set(values)
+                     if value is not None}
+        return [None if value is None else converted[value]
+                for value in values]
+    return convert_column
 
-    if x['type'] != 'Point':
-        raise ValueError(x)
-    coordinates = x['coordinates']
-    return f'POINT({coordinates[0]} {coordinates[1]})'
 
+# Column-at-a-time versions of the date transforms: each distinct value in
+# the column is converted once.
+batch_edm_date_to_epoch_days = _batch(_epoch_days)
+batch_edm_date_to_millis = _batch(_epoch_millis)
 
-def transform_edm_multiline_to_multilineliteral(x):
-    if x is None:
-        return x
 
-    if x['type'] != 'MultiLineString':
-        raise ValueError(x)
-    coordinates = x['coordinates']
-    # Array of Lines.
-    # Each line is an array of points.
-    return 'MULTILINESTRING (%s)' % (','.join(
-        ['(%s)' % ','.join([f'{point[0]} {point[1]}' for point in line])
-         for line in coordinates]))
+def _points_wkt(points):
+    """'x y,x y,...' for a list of positions, formatted in one go.
 
+    %s formats numbers exactly like the f'{point[0]} {point[1]}' this
+    replaces, without building a string per point. Positions are assumed
+    to have two coordinates; anything else takes the per-point path.
+    """
+    flat = tuple(chain.from_iterable(points))
+    if len(flat) != 2 * len(points):
+        return ','.join([f'{point[0]} {point[1]}' for point in points])
+    # The template costs next to nothing beside formatting into it, so it
+    # is built per call rather than cached per point count.
+    return ('%s %s,' * len(points))[:-1] % flat
 
-def transform_edm_linestring_to_linestring(x):
-    if x is None:
-        return x
 
-    if x['type'] != 'LineString':
-        raise ValueError(x)
-    coordinates = x['coordinates']
-    # Array of Lines.
-    # Each line is an array of points.
-    return 'LINESTRING (%s)' % ','.join([
-        f'{point[0]} {point[1]}' for point in coordinates])
+def _point_wkt(coordinates):
+    return f'POINT({coordinates[0]} {coordinates[1]})'
 
 
-def transform_edm_multipoint_to_multipoint(x):
-    if x is None:
-        return x
+def _linestring_wkt(coordinates):
+    return 'LINESTRING (%s)' % _points_wkt(coordinates)
 
-    if x['type'] != 'MultiPoint':
-        raise ValueError(x)
-    coordinates = x['coordinates']
-    # Array of Lines.
-    # Each line is an array of points.
-    return 'MULTIPOINT (%s)' % ','.join([
-        f'{point[0]} {point[1]}' for point in coordinates])
 
+def _multipoint_wkt(coordinates):
+    return 'MULTIPOINT (%s)' % _points_wkt(coordinates)
 
-def transform_edm_multipolygon_to_multipolygon(x):
-    if x is None:
-        return x
 
-    if x['type'] != 'MultiPolygon':
-        raise ValueError(x)
+def _multiline_wkt(coordinates):
+    # Array of Lines.
+    # Each line is an array of points.
+    return 'MULTILINESTRING (%s)' % ','.join(
+        ['(%s)' % _points_wkt(line) for line in coordinates])
+
 
-    coordinates = x['coordinates']
+def _multipolygon_wkt(coordinates):
     # Array of Polygons
     # Polygon is array of mulitpoints
     # A multipoint is an array of points
     return 'MULTIPOLYGON (%s)' % ','.join(
-        ['(%s)' % ','.join([
-            '(%s)' % ','.join([f'{point[0]} {point[1]}'
-                               for point in multipoint])
-            for multipoint in polygon])
+        ['(%s)' % ','.join(['(%s)' % _points_wkt(multipoint)
+                            for multipoint in polygon])
          for polygon in coordinates])
 
 
+# WKB geometry type codes, and the byte order flag for native doubles.
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_POLYGON = 3
+WKB_MULTIPOINT = 4
+WKB_MULTILINESTRING = 5
+WKB_MULTIPOLYGON = 6
+_WKB_BYTE_ORDER = 1 if sys.byteorder == 'little' else 0
+
+
+def _wkb_header(geometry_type, count=None):
+    if count is None:
+        return struct.pack('=BI', _WKB_BYTE_ORDER, geometry_type)
+    return struct.pack('=BII', _WKB_BYTE_ORDER, geometry_type, count)
+
+
+def _wkb_points(points):
+    """Count followed by the packed doubles of a list of positions."""
+    return (struct.pack('=I', len(points))
+            + array('d', [c for point in points for c in point[:2]])
+            .tobytes())
+
+
+def _point_wkb(coordinates):
+    return (_wkb_header(WKB_POINT)
+            + array('d', coordinates[:2]).tobytes())
+
+
+def _linestring_wkb(coordinates):
+    return _wkb_header(WKB_LINESTRING) + _wkb_points(coordinates)
+
+
+def _polygon_wkb(rings):
+    return b''.join([_wkb_header(WKB_POLYGON, len(rings))]
+                    + [_wkb_points(ring) for ring in rings])
+
+
+def _multipoint_wkb(coordinates):
+    return b''.join([_wkb_header(WKB_MULTIPOINT, len(coordinates))]
+                    + [_point_wkb(point) for point in coordinates])
+
+
+def _multiline_wkb(coordinates):
+    return b''.join([_wkb_header(WKB_MULTILINESTRING, len(coordinates))]
+                    + [_linestring_wkb(line) for line in coordinates])
+
+
+def _multipolygon_wkb(coordinates):
+    return b''.join([_wkb_header(WKB_MULTIPOLYGON, len(coordinates))]
+                    + [_polygon_wkb(polygon) for polygon in coordinates])
+
+
+WKT_ENCODERS = {
+    'Point': _point_wkt,
+    'LineString': _linestring_wkt,
+    'MultiPoint': _multipoint_wkt,
+    'MultiLineString': _multiline_wkt,
+    'MultiPolygon': _multipolygon_wkt,
+}
+
+WKB_ENCODERS = {
+    'Point': _point_wkb,
+    'LineString': _linestring_wkb,
+    'MultiPoint': _multipoint_wkb,
+    'MultiLineString': _multiline_wkb,
+    'MultiPolygon': _multipolygon_wkb,
+}
+
+
+def encode_geography(values, geometry_type=None, wkb=False):
+    """Encodes a column of GeoJSON geometries (None allowed) in bulk.
+
+    Returns WKT strings identical to the transform_edm_* geography
+    functions, or WKB bytes if `wkb` is set. If `geometry_type` is given,
+    any other geometry raises ValueError like those functions do.
+    """
+    encoders = WKB_ENCODERS if wkb else WKT_ENCODERS
+    results = []
+    for value in values:
+        if value is None:
+            results.append(None)
+            continue
+
+        value_type = value['type']
+        if geometry_type is not None and value_type != geometry_type:
+            raise ValueError(value)
+        try:
+            encode = encoders[value_type]
+        except KeyError:
+            raise ValueError(value)
+        results.append(encode(value['coordinates']))
+    return results
+
+
+def _geography_transform(geometry_type):
+    encode = WKT_ENCODERS[geometry_type]
+
+    def transform(x):
+        if x is None:
+            return x
+
+        if x['type'] != geometry_type:
+            raise ValueError(x)
+        return encode(x['coordinates'])
+
+    return transform
+
+
+transform_edm_point_to_pointliteral = _geography_transform('Point')
+transform_edm_multiline_to_multilineliteral = _geography_transform(
+    'MultiLineString')
+transform_edm_linestring_to_linestring = _geography_transform('LineString')
+transform_edm_multipoint_to_multipoint = _geography_transform('MultiPoint')
+transform_edm_multipolygon_to_multipolygon = _geography_transform(
+    'MultiPolygon')
+
+# Every transform a simple type can have, by name, so schemas can be
+# cached without their callables (see save_schemas).
+TRANSFORMS = {
+    'identity': identity,
+    'transform_edm_date_to_epoch_days': transform_edm_date_to_epoch_days,
+    'transform_edm_date_to_millis': transform_edm_date_to_millis,
+    'transform_edm_point_to_pointliteral':
+        transform_edm_point_to_pointliteral,
+    'transform_edm_linestring_to_linestring':
+        transform_edm_linestring_to_linestring,
+    'transform_edm_multipoint_to_multipoint':
+        transform_edm_multipoint_to_multipoint,
+    'transform_edm_multiline_to_multilineliteral':
+        transform_edm_multiline_to_multilineliteral,
+    'transform_edm_multipolygon_to_multipolygon':
+        transform_edm_multipolygon_to_multipolygon,
+}
+TRANSFORM_NAMES = {transform: name for name, transform in TRANSFORMS.items()}
+
+# Version of the schemas save_schemas writes, part of their cache key. Bump
+# it whenever edm_to_schema_type, a transform or the saved format changes,
+# so schemas cached by older code are parsed again.
+SCHEMA_CACHE_VERSION = 1
+
+BATCH_TRANSFORMS = {
+    transform_edm_date_to_epoch_days: batch_edm_date_to_epoch_days,
+    transform_edm_date_to_millis: batch_edm_date_to_millis,
+    transform_edm_point_to_pointliteral: functools.partial(
+        encode_geography, geometry_type='Point'),
+    transform_edm_linestring_to_linestring: functools.partial(
+        encode_geography, geometry_type='LineString'),
+    transform_edm_multipoint_to_multipoint: functools.partial(
+        encode_geography, geometry_type='MultiPoint'),
+    transform_edm_multiline_to_multilineliteral: functools.partial(
+        encode_geography, geometry_type='MultiLineString'),
+    transform_edm_multipolygon_to_multipolygon: functools.partial(
+        encode_geography, geometry_type='MultiPolygon'),
+}
+
+
 def edm_to_schema_type(edm_node):
     """Returns a schmea type which is sql_type, avro_type, transform"""
     edm_type = edm_node.get('Type')
@@ -313,7 +515,7 @@ def edm_to_schema_type(edm_node):
             raise NotImplementedError(edm_type)
 
 
-def merge_property(metadata, schema, prop):
+def merge_property(index, schema, prop):
     """Converts the property into a SQL schema.
 
     May add multiple properties if there are complex ones.
@@ -325,26 +527,24 @@ def merge_property(metadata, schema, prop):
         schema[prop_name] = edm_to_schema_type(prop)
     elif prop_type.startswith(SOCRATA_PREFIX):
         schema_type = complex_type_to_schema(
-            metadata,
+            index,
             prop_name,
             prop_type[len(SOCRATA_PREFIX):])
         schema[prop_name] = schema_type
 
 
 @functools.cache
-def complex_type_to_schema(metadata, namespace, type_name):
+def complex_type_to_schema(index, namespace, type_name):
     """Returns a schmea type which is sql_type, avro_type, transform"""
-    type_element = metadata.findall(f'.//edm:ComplexType[@Name="{type_name}"]',
-                                    ODATA_NS)[0]
     fields = []
-    for prop in type_element.findall('./edm:Property', ODATA_NS):
+    for prop in index.complex_types[type_name]:
         prop_type = prop.get('Type')
         prop_name = prop.get('Name')
         if prop_type.startswith('Edm.'):
             schema_type = edm_to_schema_type(prop).items()
         elif prop_type.startswith('socrata.'):
             schema_type = complex_type_to_schema(
-                metadata,
+                index,
                 f'{namespace}_{prop_name}',
                 prop_type[len(SOCRATA_PREFIX):])
         else:
@@ -355,13 +555,6 @@ def complex_type_to_schema(metadata, namespace, type_name):
             field[k] = v
         fields.append(field)
 
-    def transform_complex(value):
-        if value is None:
-            return None
-
-        return {f['name']: transform_complex_field(f, value)
-                for f in fields}
-
     return {
         'sql_type': 'STRUCT',
         'avro_type': {
@@ -370,27 +563,227 @@ def complex_type_to_schema(metadata, namespace, type_name):
             'name': type_name,
             'fields': fields,
         },
-        'transform': transform_complex,
+        'transform': _complex_transform(fields),
     }
 
 
+def _complex_transform(fields):
+    names = [f['name'] for f in fields]
+    converters = [(f['name'], f['transform']) for f in fields
+                  if f['transform'] is not identity]
+
+    def transform_complex(value):
+        if value is None:
+            return None
+
+        result = {name: value[name] for name in names}
+        for name, convert in converters:
+            field_value = result[name]
+            if field_value is not None:
+                result[name] = convert(field_value)
+        return result
+
+    return transform_complex
+
+
+def compile_transform(schema):
+    """Builds a function that transforms one row of `schema`.
+
+    Identity fields are copied as-is and the remaining converters are bound
+    up front, so per row there are no schema lookups and no calls for
+    fields that need no conversion.
+    """
+    converters = tuple((name, field['transform'])
+                       for name, field in schema.items()
+                       if field['transform'] is not identity)
+
+    def transform_row(row):
+        result = dict(row)
+        for name, convert in converters:
+            if name in result:
+                result[name] = convert(result[name])
+        return result
+
+    return transform_row
+
+
+def compile_page_transform(schema):
+    """Builds a function that transforms a page (list) of rows of `schema`.
+
+    Columns that have a BATCH_TRANSFORMS converter are converted
+    column-at-a-time; the rest go through compile_transform.
+    """
+    batched = [(name, BATCH_TRANSFORMS[field['transform']])
+               for name, field in schema.items()
+               if field['transform'] in BATCH_TRANSFORMS]
+    if not batched:
+        transform_row = compile_transform(schema)
+        return lambda rows: [transform_row(row) for row in rows]
+
+    transform_row = compile_transform(
+        {name: field for name, field in schema.items()
+         if field['transform'] not in BATCH_TRANSFORMS})
+
+    def transform_rows(rows):
+        values = [transform_row(row) for row in rows]
+        for name, convert_column in batched:
+            column = convert_column([row.get(name) for row in values])
+            for row, converted in zip(values, column):
+                if name in row:
+                    row[name] = converted
+        return values
+
+    return transform_rows
+
+
+class MetadataIndex:
+    """The entity types, complex types and entity sets of a $metadata
+    document, indexed by name. Types map to the attributes of each of
+    their properties.
+    """
+
+    def __init__(self, entity_types, complex_types, entity_sets):
+        self.entity_types = entity_types
+        self.complex_types = complex_types
+        self.entity_sets = entity_sets
+
+
+def _properties(type_element):
+    return [dict(prop.attrib)
+            for prop in type_element.iterfind('./edm:Property', ODATA_NS)]
+
+
+def iterparse_metadata(source):
+    """Builds a MetadataIndex from a $metadata file object (or file name)
+    with iterparse, clearing each type and entity container as soon as
+    it has been read instead of building the whole tree.
+    """
+    edm = '{%s}' % ODATA_NS['edm']
+    entity_types = {}
+    complex_types = {}
+    entity_sets = []
+    for _, element in ET.iterparse(source):
+        if element.tag == f'{edm}EntityType':
+            entity_types[element.get('Name')] = _properties(element)
+        elif element.tag == f'{edm}ComplexType':
+            complex_types[element.get('Name')] = _properties(element)
+        elif element.tag == f'{edm}EntityContainer':
+            if element.get('Name') == 'Service':
+                entity_sets.extend(
+                    entity_set.get('Name')
+                    for entity_set in element.iterfind('./edm:EntitySet',
+                                                       ODATA_NS))
+        elif element.tag != f'{edm}Schema':
+            continue
+        element.clear()
+
+    return MetadataIndex(entity_types, complex_types, entity_sets)
+
+
+def index_metadata(metadata):
+    """Builds a MetadataIndex from a parsed $metadata document, or from a
+    file object with iterparse_metadata.
+    """
+    if isinstance(metadata, MetadataIndex):
+        return metadata
+    if hasattr(metadata, 'read'):
+        return iterparse_metadata(metadata)
+
+    return MetadataIndex(
+        {entity_type.get('Name'): _properties(entity_type)
+         for entity_type in metadata.iterfind('.//edm:EntityType',
+                                              ODATA_NS)},
+        {complex_type.get('Name'): _properties(complex_type)
+         for complex_type in metadata.iterfind('.//edm:ComplexType',
+                                               ODATA_NS)},
+        [element.get('Name')
+         for element in metadata.iterfind(
+             './/edm:EntityContainer[@Name="Service"]/edm:EntitySet',
+             ODATA_NS)])
+
+
 def get_schemas(metadata):
+    """Schemas of every entity type of `metadata`: a parsed $metadata
+    document, a file to stream it from or a MetadataIndex.
+    """
+    index = index_metadata(metadata)
     schemas = {}
-    for entity_type in metadata.findall('.//edm:EntityType', ODATA_NS):
+    for fourfour_id, properties in index.entity_types.items():
         cur_schema = {}
-        for prop in entity_type.findall('./edm:Property', ODATA_NS):
-            merge_property(metadata, cur_schema, prop)
-
-        fourfour_id = entity_type.get('Name')
+        for prop in properties:
+            merge_property(index, cur_schema, prop)
         schemas[fourfour_id] = cur_schema
 
     return schemas
 
 
 def get_entity_sets(metadata):
-    entity_sets = []
-    for element in metadata.findall('.//edm:EntityContainer[@Name="Service"]'
-                                    '/edm:EntitySet',
-                                    ODATA_NS):
-        entity_sets.append(element.get('Name'))
-    return entity_sets
+    return list(index_metadata(metadata).entity_sets)
+
+
+class HashingReader:
+    """File wrapper computing the SHA-256 of what is read through it, e.g.
+    while iterparse_metadata streams a download.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data.encode() if isinstance(data, str) else data)
+        return data
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def _without_transform(field):
+    """Copy of a schema field with its transform replaced by its name."""
+    if field['sql_type'] == 'STRUCT':
+        avro_type = dict(field['avro_type'])
+        avro_type['fields'] = [_without_transform(f)
+                               for f in avro_type['fields']]
+        return dict(field, avro_type=avro_type, transform=None)
+    return dict(field, transform=TRANSFORM_NAMES[field['transform']])
+
+
+def _restore_transform(field):
+    """Undoes _without_transform, in place."""
+    if field['sql_type'] == 'STRUCT':
+        for f in field['avro_type']['fields']:
+            _restore_transform(f)
+        field['transform'] = _complex_transform(field['avro_type']['fields'])
+    else:
+        field['transform'] = TRANSFORMS[field['transform']]
+
+
+def schema_cache_name(digest):
+    """File name of the schemas cached for the $metadata whose SHA-256 is
+    `digest`, by this SCHEMA_CACHE_VERSION.
+    """
+    return f'{digest}.v{SCHEMA_CACHE_VERSION}.json'
+
+
+def save_schemas(path, schemas, entity_sets):
+    """Writes `schemas` and `entity_sets` to `path` as JSON, with each
+    transform replaced by its name.
+    """
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump({'schemas': {entity: {name: _without_transform(field)
+                                        for name, field in schema.items()}
+                               for entity, schema in schemas.items()},
+                   'entity_sets': entity_sets}, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def load_schemas(path):
+    """Reads (schemas, entity_sets) saved by save_schemas."""
+    with open(path) as f:
+        saved = json.load(f)
+    schemas = saved['schemas']
+    for schema in schemas.values():
+        for field in schema.values():
+            _restore_transform(field)
+    return schemas, saved['entity_sets']
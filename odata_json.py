@@ -0,0 +1,117 @@
+"""
+Streaming reader for OData JSON collection pages.
+
+Rows of the `value` array are parsed straight off the response byte stream
+by ijson and handed on in chunks, so memory is bounded by the chunk rather
+than by the page. Control information such as @odata.nextLink comes before
+or after `value`, so it is picked out of the first and last bytes that went
+through the parser instead of buffering the body.
+"""
+
+import json
+import re
+import time
+
+import ijson
+
+# Set on every chunk of a page except the last one, which instead carries
+# the page's @odata.nextLink / @odata.deltaLink.
+PARTIAL_PAGE = '@partial'
+
+# How much of the start and end of the body to keep for annotations.
+KEEP_BYTES = 65536
+
+ANNOTATION_REGEX = re.compile(rb'"(@odata\.(?:nextLink|deltaLink))"\s*:\s*')
+
+
+class ReadWrapper:
+    """File wrapper that hands what each read() returns to seen(), along
+    with the perf_counter() from just before the read. Works over both
+    plain and async (coroutine read) files.
+    """
+
+    def __init__(self, fileobj, is_async=False):
+        self.fileobj = fileobj
+        if is_async:
+            self.read = self._read_async
+        else:
+            self.read = self._read
+
+    def seen(self, data, started):
+        return data
+
+    def _read(self, size=-1):
+        started = time.perf_counter()
+        return self.seen(self.fileobj.read(size), started)
+
+    async def _read_async(self, size=-1):
+        started = time.perf_counter()
+        return self.seen(await self.fileobj.read(size), started)
+
+
+class _HeadTail(ReadWrapper):
+    """File wrapper that remembers the first and last bytes read through
+    it.
+    """
+
+    def __init__(self, fileobj, is_async=False):
+        super().__init__(fileobj, is_async)
+        self.head = b''
+        self.tail = b''
+
+    def seen(self, data, started):
+        if len(self.head) < KEEP_BYTES:
+            self.head += data[:KEEP_BYTES - len(self.head)]
+        self.tail = (self.tail + data)[-KEEP_BYTES:]
+        return data
+
+    def annotations(self):
+        found = {}
+        decoder = json.JSONDecoder()
+        for blob in (self.head, self.tail):
+            for m in ANNOTATION_REGEX.finditer(blob):
+                text = blob[m.end():].decode('utf-8', 'replace')
+                try:
+                    value, _ = decoder.raw_decode(text)
+                except ValueError:
+                    continue
+                found[m.group(1).decode()] = value
+        return found
+
+
+def iter_page(fileobj, chunk_rows):
+    """Yields a page read from `fileobj` as dicts shaped like the page,
+    each with at most `chunk_rows` rows in 'value'.
+    """
+    stream = _HeadTail(fileobj)
+    rows = []
+    for row in ijson.items(stream, 'value.item', use_float=True):
+        rows.append(row)
+        if len(rows) >= chunk_rows:
+            yield {'value': rows, PARTIAL_PAGE: True}
+            rows = []
+
+    while stream.read(KEEP_BYTES):
+        pass
+
+    page = {'value': rows}
+    page.update(stream.annotations())
+    yield page
+
+
+async def aiter_page(fileobj, chunk_rows):
+    """iter_page over an async file such as aiohttp's response.content."""
+    stream = _HeadTail(fileobj, is_async=True)
+    rows = []
+    async for row in ijson.items(stream, 'value.item', use_float=True):
+        rows.append(row)
+        if len(rows) >= chunk_rows:
+            yield {'value': rows, PARTIAL_PAGE: True}
+            rows = []
+
+    while await stream.read(KEEP_BYTES):
+        pass
+
+    page = {'value': rows}
+    page.update(stream.annotations())
+    yield page
@@ -6,16 +6,31 @@ endpoint and stuffing it into bigquery.
 """
 
 import argparse
+import asyncio
 import json
 import logging
+import os
+import queue
 import random
-import requests
-import xml.etree.ElementTree as ET
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from fastavro import writer, parse_schema
+from fastavro.write import Writer
 from google.cloud import storage
 from google.cloud.storage.retry import DEFAULT_RETRY
-from odata import get_schemas, get_entity_sets
+from http_session import AsyncHttpClient, HttpClient
+from metrics import (EntityMetrics, RunReport, TimedReader, add_page_metrics,
+                     ameasure_chunks, measure_chunks, profiles)
+from odata import (HashingReader, compile_page_transform, get_schemas,
+                   get_entity_sets, index_metadata, load_schemas,
+                   save_schemas, schema_cache_name)
+from odata_json import PARTIAL_PAGE, aiter_page, iter_page
+import bigquery_load
+import http_session
 
 
 logger = logging.getLogger(__name__)
@@ -25,13 +40,114 @@ bucket = storage_client.bucket('sps-btn-data-all-data')
 
 ODATA_ENDPOINT = 'https://data.wa.gov/api/odata/v4'
 
+# Uncompressed size at which an Avro block is compressed and written.
+DEFAULT_BLOCK_BYTES = 1024 * 1024
+
+# Serializes checkpoint writes when scraping with several workers.
+checkpoint_lock = threading.Lock()
+
+
+def getMetadata(http, headers=None):
+    """Requests $metadata, leaving the body to stream from response.raw."""
+    response = http.get(ODATA_ENDPOINT + '/$metadata', headers=headers,
+                        stream=True)
+    response.raw.decode_content = True
+    return response
+
+
+def parse_metadata(fileobj, cache_dir=None):
+    """Returns (schemas, entity_sets) of the $metadata document streamed
+    from `fileobj`, plus its hash. The schemas are saved in `cache_dir`
+    under that hash.
+    """
+    reader = HashingReader(fileobj)
+    index = index_metadata(reader)
+    schemas, entity_sets = get_schemas(index), get_entity_sets(index)
+    digest = reader.hexdigest()
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_schemas(os.path.join(cache_dir, schema_cache_name(digest)),
+                     schemas, entity_sets)
+    return (schemas, entity_sets), digest
+
 
-def getMetadata():
-    response = requests.get(ODATA_ENDPOINT + '/$metadata')
-    if response.status_code != 200:
-        raise ValueError(response)
+def load_cached_schemas(path):
+    """Returns load_schemas(path), or None if the cached schemas cannot be
+    read, e.g. because a transform they name no longer exists.
+    """
+    try:
+        schemas = load_schemas(path)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f'METADATA: ignoring unreadable cache {path}: {e!r}')
+        return None
+    logger.info(f'METADATA: using cached {path}')
+    return schemas
 
-    return response.text
+
+def read_metadata(fileobj, cache_dir=None):
+    """Returns (schemas, entity_sets) of a $metadata file, from
+    `cache_dir` if that document has been parsed before.
+    """
+    if cache_dir:
+        digest = HashingReader(fileobj)
+        while digest.read(1024 * 1024):
+            pass
+        path = os.path.join(cache_dir, schema_cache_name(digest.hexdigest()))
+        cached = os.path.exists(path) and load_cached_schemas(path)
+        if cached:
+            return cached
+        fileobj.seek(0)
+
+    return parse_metadata(fileobj, cache_dir)[0]
+
+
+def fetch_metadata(http, cache_dir=None, max_age=0):
+    """Returns (schemas, entity_sets) of the endpoint's $metadata.
+
+    The hash, ETag and Last-Modified of the last download are kept in
+    `cache_dir`. Within `max_age` seconds of it, or if the endpoint says
+    the document is not modified, the cached schemas are used without
+    downloading it again.
+    """
+    latest_path = cache_dir and os.path.join(cache_dir, 'latest.json')
+    latest = None
+    if cache_dir and os.path.exists(latest_path):
+        with open(latest_path) as f:
+            latest = json.load(f)
+        # Schemas cached by another SCHEMA_CACHE_VERSION are not found.
+        cached = os.path.join(cache_dir, schema_cache_name(latest['hash']))
+        cached_schemas = (os.path.exists(cached)
+                          and load_cached_schemas(cached))
+        if not cached_schemas:
+            latest = None
+
+    headers = {}
+    if latest is not None:
+        if time.time() - latest['fetched'] < max_age:
+            return cached_schemas
+        if latest['etag']:
+            headers['If-None-Match'] = latest['etag']
+        if latest['last_modified']:
+            headers['If-Modified-Since'] = latest['last_modified']
+
+    with getMetadata(http, headers) as response:
+        if response.status_code == 304 and latest is not None:
+            logger.info('METADATA: not modified')
+            latest['fetched'] = time.time()
+            result = cached_schemas
+        elif response.status_code == 200:
+            result, digest = parse_metadata(response.raw, cache_dir)
+            latest = {'hash': digest,
+                      'etag': response.headers.get('ETag'),
+                      'last_modified': response.headers.get('Last-Modified'),
+                      'fetched': time.time()}
+        else:
+            raise ValueError(response)
+
+    if cache_dir:
+        with open(latest_path, 'w') as f:
+            json.dump(latest, f)
+    return result
 
 
 def to_field_value(field):
@@ -97,85 +213,1101 @@ def entity_path(name):
     return f'raw/ospi/odata/{name}'
 
 
-def checkpoint_exists(name):
-    return bucket.blob(f'{entity_path(name)}.done').exists()
+# Kinds of blob kept per entity besides its checkpoint, by what follows
+# `{entity}.` in their names: the saved progress, the Avro parts uploaded
+# so far and the delta partitions (directories end in `/`).
+STORED_BLOBS = {'progress': 'progress', 'parts': 'avro.parts',
+                'deltas': 'delta'}
+
+
+class CheckpointIndex:
+    """The `.done` checkpoints of every entity set, from one listing.
+
+    write_checkpoint copies `ok` into the blob's metadata, so the listing
+    alone tells whether an entity succeeded. Checkpoint bodies are only
+    downloaded, concurrently, when `read_all` is set (incremental runs
+    need the watermarks) or for checkpoints written without that metadata,
+    and never without `read`.
+
+    The same listing gives each entity's other blobs (see stored), so
+    scraping it needs no lookups of its own.
+    """
+
+    def __init__(self, blobs, bodies, stored=None):
+        self.blobs = blobs
+        self.bodies = bodies
+        self._stored = stored
+
+    @classmethod
+    def load(cls, read_all=False, workers=16, listing=None, read=True):
+        """Lists the checkpoints, or picks them out of `listing`, the
+        blobs under entity_path('') if already listed.
+        """
+        prefix = entity_path('')
+        if listing is None:
+            listing = bucket.list_blobs(prefix=prefix)
+        blobs = {}
+        stored = {}
+        for blob in listing:
+            name = blob.name[len(prefix):]
+            if name.endswith('.done') and '/' not in name:
+                blobs[name[:-len('.done')]] = blob
+                continue
+            entity, _, rest = name.partition('.')
+            kind = next((kind for kind, start in STORED_BLOBS.items()
+                         if rest == start or rest.startswith(f'{start}/')),
+                        None)
+            if kind is not None:
+                stored.setdefault(entity, {}).setdefault(kind, []).append(
+                    blob)
+
+        unread = [entity for entity, blob in blobs.items()
+                  if read and (read_all
+                               or 'ok' not in (blob.metadata or {}))]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            bodies = dict(zip(unread, executor.map(
+                lambda entity: json.loads(blobs[entity].download_as_text()),
+                unread)))
+
+        logger.info(f'CHECKPOINT: {len(blobs)} found, '
+                    f'{len(bodies)} downloaded')
+        return cls(blobs, bodies, stored)
+
+    def __contains__(self, entity):
+        return entity in self.blobs
+
+    def ok(self, entity):
+        """True or False from the checkpoint, or None if there is none."""
+        if entity not in self.blobs:
+            return None
+        if entity in self.bodies:
+            return bool(self.bodies[entity].get('ok'))
+        return self.blobs[entity].metadata['ok'] == 'true'
+
+    def stored(self, entity):
+        """The blobs of `entity` in the listing by kind (see STORED_BLOBS),
+        or None if the index was not built from a listing.
+        """
+        if self._stored is None:
+            return None
+        listed = self._stored.get(entity, {})
+        return {kind: listed.get(kind, []) for kind in STORED_BLOBS}
+
+    def read(self, entity):
+        """Returns the JSON status of a checkpoint, or None."""
+        if entity not in self.blobs:
+            return None
+        if entity not in self.bodies:
+            self.bodies[entity] = json.loads(
+                self.blobs[entity].download_as_text())
+        return self.bodies[entity]
 
 
 def write_checkpoint(name, value):
-    logger.info(f'CHECKPOINT {name}: writing: {repr(value)}')
-    return bucket.blob(f'{entity_path(name)}.done').upload_from_string(
-        json.dumps(value),
-        content_type="application/json",
-        retry=DEFAULT_RETRY)
+    with checkpoint_lock:
+        logger.info(f'CHECKPOINT {name}: writing: {repr(value)}')
+        blob = bucket.blob(f'{entity_path(name)}.done')
+        blob.metadata = {'ok': 'true' if value.get('ok') else 'false'}
+        return blob.upload_from_string(
+            json.dumps(value),
+            content_type="application/json",
+            retry=DEFAULT_RETRY)
 
 
-def scrape_all_entities(schemas, entity_sets, tempfile, force, skip_upload):
-    random.shuffle(entity_sets)
-    for entity in entity_sets:
-        if not force and checkpoint_exists(entity):
+class EntityProgress:
+    """Page level progress of one entity, kept in GCS so a crawl can resume.
+
+    While an entity is paged, the growing Avro tempfile is uploaded in
+    parts every `every_pages` pages: part 0 is the Avro header and each
+    later part is the run of blocks written since the previous one.
+    `{entity}.progress` records the parts uploaded so far and the nextLink
+    to continue from. A restarted run downloads the header, continues from
+    that nextLink, and on completion the parts are composed into
+    `{entity}.avro` (or, for an incremental run, the delta partition named
+    by `avro_name`).
+
+    The progress also tracks the high-water mark of the watermark column
+    and any @odata.deltaLink seen, for incremental runs.
+
+    An `every_pages` of None disables saving.
+
+    With `stream_upload` (an upload chunk size in bytes) the Avro file is
+    not written to the tempfile at all but streamed to its blob through a
+    resumable upload; there is nothing to save, so `every_pages` is
+    ignored.
+
+    `stored` is the entity's blobs from the run's listing, as given by
+    CheckpointIndex.stored; without it, they are looked up in GCS.
+    """
+
+    def __init__(self, entity, tempfile, every_pages, state,
+                 stream_upload=None, stored=None):
+        self.entity = entity
+        self.tempfile = tempfile
+        self.every_pages = every_pages
+        self.state = state
+        self.stream_upload = stream_upload
+        self.stored = stored
+        self.header_size = 0
+        self.uploaded = 0
+        self.pending_pages = 0
+
+    @classmethod
+    def start(cls, entity, tempfile, every_pages, resume, since=None,
+              stream_upload=None, stored=None):
+        """Returns the saved progress of `entity`, or fresh progress.
+
+        `since` is the checkpoint of the previous run when this run only
+        fetches rows from its watermark on.
+        """
+        if stream_upload:
+            every_pages = None
+
+        if every_pages is not None and resume:
+            progress_blob = bucket.blob(f'{entity_path(entity)}.progress')
+            if (progress_blob.exists() if stored is None
+                    else stored['progress']):
+                state = json.loads(progress_blob.download_as_text())
+                logger.info(f'PROGRESS {entity}: resuming after '
+                            f'{state["pages"]} pages, {state["rows"]} rows')
+                return cls(entity, tempfile, every_pages, state,
+                           stored=stored)
+
+        if since is None:
+            avro_name = f'{entity_path(entity)}.avro'
+        else:
+            stamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+            avro_name = f'{entity_path(entity)}.delta/{stamp}.avro'
+
+        return cls(entity, tempfile, every_pages,
+                   {'next_url': None, 'parts': 0, 'pages': 0, 'rows': 0,
+                    'avro_bytes': 0, 'avro_name': avro_name, 'since': since,
+                    'watermark': None, 'delta_link': None},
+                   stream_upload, stored)
+
+    @property
+    def next_url(self):
+        return self.state['next_url']
+
+    def part_blob(self, index):
+        return bucket.blob(f'{entity_path(self.entity)}.avro.parts/'
+                           f'{index:06d}')
+
+    def open(self, entity_schema, avro_options):
+        """Opens the tempfile, starting with the (possibly saved) header,
+        and returns an AvroBlockWriter appending to it.
+        """
+        schema = parse_schema(to_avro_schema(entity_schema, self.entity))
+        if self.stream_upload:
+            upload = bucket.blob(self.state['avro_name']).open(
+                'wb', chunk_size=self.stream_upload, ignore_flush=True,
+                content_type='application/avro', retry=DEFAULT_RETRY)
+            return AvroBlockWriter(upload, schema=schema, **avro_options)
+
+        opened_file = open(self.tempfile, 'wb+')
+        if self.state['parts']:
+            self.part_blob(0).download_to_file(opened_file,
+                                               retry=DEFAULT_RETRY)
+        else:
+            writer(opened_file, schema, [], codec='zstandard')
+        self.header_size = self.uploaded = opened_file.tell()
+        return AvroBlockWriter(opened_file, **avro_options)
+
+    def observe(self, watermark_column, data):
+        """Tracks the high-water mark and deltaLink of a raw page."""
+        delta_link = data.get('@odata.deltaLink', None)
+        if delta_link is not None:
+            self.state['delta_link'] = delta_link
+
+        if watermark_column is None:
+            return
+
+        values = [row[watermark_column] for row in data['value']
+                  if row.get(watermark_column) is not None]
+        if not values:
+            return
+
+        page_max = max(values)
+        watermark = self.state['watermark']
+        if watermark is None or page_max > watermark['value']:
+            self.state['watermark'] = {'column': watermark_column,
+                                       'value': page_max}
+
+    def page_done(self, avro, data, rows):
+        """Records `rows` written from `data`, a page or a chunk of one."""
+        self.state['rows'] += rows
+        if data.get(PARTIAL_PAGE):
+            return
+
+        next_url = data.get('@odata.nextLink', None)
+        self.state['pages'] += 1
+        self.state['next_url'] = next_url
+        self.pending_pages += 1
+        if (self.every_pages is not None
+                and self.pending_pages >= self.every_pages
+                and next_url is not None):
+            self.save(avro)
+
+    def _upload_part(self, data):
+        self.part_blob(self.state['parts']).upload_from_string(
+            data, content_type='application/octet-stream',
+            retry=DEFAULT_RETRY)
+        self.state['parts'] += 1
+        self.state['avro_bytes'] += len(data)
+
+    def save(self, avro):
+        """Uploads blocks written since the last save and records them."""
+        if self.every_pages is None:
+            return
+
+        avro.flush()
+        opened_file = avro.fo
+        end = opened_file.tell()
+        if not self.state['parts']:
+            opened_file.seek(0)
+            self._upload_part(opened_file.read(self.header_size))
+        if end > self.uploaded:
+            opened_file.seek(self.uploaded)
+            self._upload_part(opened_file.read(end - self.uploaded))
+        opened_file.seek(end)
+        self.uploaded = end
+        self.pending_pages = 0
+
+        logger.info(f'PROGRESS {self.entity}: {self.state["pages"]} pages, '
+                    f'{self.state["parts"]} parts')
+        progress_blob = bucket.blob(f'{entity_path(self.entity)}.progress')
+        progress_blob.upload_from_string(
+            json.dumps(self.state),
+            content_type='application/json',
+            retry=DEFAULT_RETRY)
+        if self.stored is not None and not self.stored['progress']:
+            self.stored['progress'] = [progress_blob]
+
+    def finish(self):
+        """Composes the parts and the rest of the closed tempfile into
+        the Avro blob. Returns False if nothing was uploaded in parts,
+        in which case the caller uploads the tempfile whole.
+        """
+        if self.stream_upload:
+            # AvroBlockWriter.close() finalized the upload.
+            return True
+
+        if not self.state['parts']:
+            self.clear()
+            return False
+
+        with open(self.tempfile, 'rb') as opened_file:
+            opened_file.seek(self.uploaded)
+            tail = opened_file.read()
+        if tail:
+            self._upload_part(tail)
+
+        # GCS composes at most 32 objects at a time.
+        parts = [self.part_blob(i) for i in range(self.state['parts'])]
+        avro_blob = bucket.blob(self.state['avro_name'])
+        avro_blob.content_type = 'application/avro'
+        avro_blob.compose(parts[:32], retry=DEFAULT_RETRY)
+        for i in range(32, len(parts), 31):
+            avro_blob.compose([avro_blob] + parts[i:i + 31],
+                              retry=DEFAULT_RETRY)
+
+        self.clear()
+        return True
+
+    def clear(self):
+        """Deletes the saved progress and any uploaded parts."""
+        if self.every_pages is None:
+            return
+
+        if self.stored is None:
+            for blob in bucket.list_blobs(
+                    prefix=f'{entity_path(self.entity)}.avro.parts/'):
+                blob.delete()
+            progress_blob = bucket.blob(
+                f'{entity_path(self.entity)}.progress')
+            if progress_blob.exists():
+                progress_blob.delete()
+            return
+
+        # The listed parts, left by earlier runs, and those uploaded since.
+        names = {blob.name for blob in self.stored['parts']}
+        names.update(self.part_blob(i).name
+                     for i in range(self.state['parts']))
+        for name in sorted(names):
+            bucket.blob(name).delete(retry=DEFAULT_RETRY)
+        for blob in self.stored['progress']:
+            blob.delete(retry=DEFAULT_RETRY)
+        self.stored['parts'] = self.stored['progress'] = []
+
+
+class RateLimiter:
+    """Spaces out requests across threads to at most `per_second`.
+
+    A `per_second` of None disables limiting.
+    """
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def reserve(self):
+        """Claims the next request slot and returns seconds to wait for it."""
+        if not self.interval:
+            return 0.0
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+
+        return max(delay, 0.0)
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PageFetchError(Exception):
+    """A page came back with something other than a 200."""
+
+    def __init__(self, status_code, text):
+        super().__init__(status_code, text)
+        self.status_code = status_code
+        self.text = text
+
+
+# Marks the end of a prefetch() queue.
+_END = object()
+
+
+def prefetch(iterable, depth):
+    """Iterates `iterable` on a background thread, at most `depth` ahead.
+
+    Exceptions raised by `iterable` are re-raised to the consumer in
+    order, after any items that were produced before them.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = None
+        try:
+            with profiles.profiled():
+                iterator = iter(iterable)
+                for item in iterator:
+                    if not put((item, None)):
+                        return
+            put((_END, None))
+        except BaseException as e:
+            put((_END, e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def fetch_pages(entity, http, rate_limiter, start_url=None,
+                stream_rows=None):
+    """Yields each decoded page of `entity`, following @odata.nextLink.
+
+    With `stream_rows`, each page is parsed as it downloads and yielded as
+    chunks of that many rows (see odata_json.iter_page).
+    Each page or chunk carries its fetch metrics; see metrics.PAGE_METRICS.
+    """
+    next_url = start_url or f'{ODATA_ENDPOINT}/{entity}'
+    while next_url is not None:
+        rate_limiter.wait()
+        start = time.perf_counter()
+        if not stream_rows:
+            response = http.get(next_url)
+            if response.status_code != 200:
+                raise PageFetchError(response.status_code, response.text)
+
+            fetched = time.perf_counter()
+            data = json.loads(response.text)
+            add_page_metrics(
+                data, latency_seconds=response.elapsed.total_seconds(),
+                fetch_seconds=fetched - start,
+                parse_seconds=time.perf_counter() - fetched,
+                body_bytes=len(response.content), retries=response.retries)
+            next_url = data.get('@odata.nextLink', None)
+            yield data
+            continue
+
+        with http.get(next_url, stream=True) as response:
+            if response.status_code != 200:
+                raise PageFetchError(response.status_code, response.text)
+
+            response.raw.decode_content = True
+            reader = TimedReader(response.raw)
+            for data in measure_chunks(iter_page(reader, stream_rows), reader,
+                                       time.perf_counter() - start,
+                                       response.retries):
+                yield data
+        next_url = data.get('@odata.nextLink', None)
+
+
+def transform_page(transform_rows, data):
+    return transform_rows(data['value'])
+
+
+def transform_pages(transform_rows, pages):
+    """Yields (values, raw page) for each page."""
+    for data in pages:
+        start = time.perf_counter()
+        values = transform_page(transform_rows, data)
+        add_page_metrics(data, transform_seconds=time.perf_counter() - start)
+        yield values, data
+
+
+class AvroBlockWriter:
+    """Appends records to an Avro file through one long-lived fastavro
+    Writer.
+
+    A block is ended once it holds `block_bytes` of uncompressed data or
+    `block_rows` records, rather than at every OData page, and compressed
+    with zstandard at `compression_level` (None for the codec default).
+
+    Without a `schema` the file must already start with an Avro header,
+    which is read back; with one, the header is written. `fo` may be a
+    write-only stream such as a GCS BlobWriter.
+    """
+
+    def __init__(self, fo, block_bytes=DEFAULT_BLOCK_BYTES, block_rows=None,
+                 compression_level=None, schema=None):
+        self.fo = fo
+        self.block_rows = block_rows or float('inf')
+        # The Writer ends a block itself at `block_bytes`; only the
+        # `block_rows` limit is enforced here.
+        self.writer = Writer(fo, schema, codec='zstandard',
+                             sync_interval=block_bytes,
+                             compression_level=compression_level)
+        self.start = fo.tell()
+        self.rows = 0
+        self.blocks = 0
+
+    def write(self, values):
+        writer = self.writer
+        for value in values:
+            writer.write(value)
+            # block_count drops back to 0 once the Writer ends a block.
+            if not writer.block_count:
+                self.blocks += 1
+            elif writer.block_count >= self.block_rows:
+                self._end_block()
+        self.rows += len(values)
+
+    def _end_block(self):
+        if self.writer.block_count:
+            self.blocks += 1
+            self.writer.flush()
+
+    def flush(self):
+        """Ends the current block and flushes the file."""
+        self._end_block()
+        self.fo.flush()
+
+    def close(self, commit=True):
+        """Flushes and closes the file. Without `commit`, an upload stream
+        is abandoned rather than finalized into a partial blob.
+        """
+        terminate = getattr(self.fo, 'terminate', None)
+        if not commit and terminate is not None:
+            self.encoded_bytes = self.fo.tell() - self.start
+            terminate()
+            return
+
+        self.flush()
+        self.encoded_bytes = self.fo.tell() - self.start
+        self.fo.close()
+
+    def stats(self):
+        written = self.encoded_bytes
+        stats = {'rows': self.rows, 'blocks': self.blocks,
+                 'avro_bytes': written}
+        if self.rows and written:
+            stats['bytes_per_row'] = round(written / self.rows, 1)
+        return stats
+
+
+def finish_entity(entity, tempfile, avro, skip_upload, progress):
+    """Uploads the closed `tempfile` for `entity` and checkpoints it."""
+    wrote_data = avro is not None
+    if wrote_data:
+        logger.info(f'AVRO {entity}: {avro.stats()}')
+
+    if skip_upload:
+        logger.info(f"Skipping upload for {entity}")
+        return
+
+    state = progress.state
+    if wrote_data and state['since'] is not None and not state['rows']:
+        logger.info(f'{entity}: no rows since {state["since"]}')
+        if progress.stream_upload:
+            bucket.blob(state['avro_name']).delete()
+        progress.clear()
+        return
+
+    if wrote_data:
+        if not progress.finish():
+            bucket.blob(state['avro_name']).upload_from_filename(
+                tempfile, content_type="application/avro",
+                retry=DEFAULT_RETRY)
+        if state['since'] is None:
+            # The new full file holds every row of the old deltas.
+            delete_deltas(entity, progress.stored)
+
+        checkpoint = {'ok': True}
+        since = state['since'] or {}
+        watermark = state['watermark'] or since.get('watermark')
+        if watermark is not None:
+            checkpoint['watermark'] = watermark
+        delta_link = state['delta_link'] or since.get('delta_link')
+        if delta_link is not None:
+            checkpoint['delta_link'] = delta_link
+        write_checkpoint(entity, checkpoint)
+    else:
+        write_checkpoint(entity, {'ok': False, 'message': 'No data?'})
+
+
+def delete_deltas(entity, stored=None):
+    """Deletes the delta partitions of `entity`, as listed in `stored` if
+    given (see CheckpointIndex.stored).
+    """
+    if stored is None:
+        deltas = bucket.list_blobs(prefix=f'{entity_path(entity)}.delta/')
+    else:
+        deltas = stored['deltas']
+    for blob in deltas:
+        logger.info(f'{entity}: deleting superseded delta {blob.name}')
+        blob.delete(retry=DEFAULT_RETRY)
+
+
+def worker_tempfiles(tempfile, workers):
+    """One tempfile per worker, suffixed with the worker number if needed."""
+    if workers == 1:
+        return [tempfile]
+    return [f'{tempfile}.{i}' for i in range(workers)]
+
+
+def plan_entity(entity, entity_schema, force, watermark_columns,
+                checkpoints, retry_failed=False):
+    """Decides how this run handles `entity`, given the CheckpointIndex
+    `checkpoints`.
+
+    Returns None to skip it, or scrape_entity keyword arguments: the
+    watermark column to track (the first of `watermark_columns` in the
+    schema) and, for an incremental run, the previous checkpoint to
+    continue from. An ok checkpoint without a high-water mark gets a full
+    fetch that records one. With `retry_failed`, only entities whose
+    checkpoint is ok: false are scraped, from scratch. The entity's
+    blobs from the listing go along as `stored`.
+    """
+    column = next((c for c in watermark_columns if c in entity_schema), None)
+    full = {'watermark_column': column, 'since': None,
+            'stored': checkpoints.stored(entity)}
+    if force:
+        return full
+
+    if retry_failed:
+        if checkpoints.ok(entity) is False:
+            logger.info(f'CHECKPOINT {entity}: retrying')
+            return full
+        return None
+
+    if column is None:
+        if entity in checkpoints:
             logger.info(f'CHECKPOINT {entity}: skip')
+            return None
+        return full
+
+    checkpoint = checkpoints.read(entity)
+    if checkpoint is None:
+        return full
+
+    if not checkpoint.get('ok'):
+        logger.info(f'CHECKPOINT {entity}: skip')
+        return None
+
+    if checkpoint.get('watermark') or checkpoint.get('delta_link'):
+        logger.info(f'CHECKPOINT {entity}: incremental since {checkpoint}')
+        return {**full, 'since': checkpoint}
+
+    # Checkpointed without a mark, e.g. before --incremental was first
+    # used. Seeding it from the current maximum would lose the rows
+    # changed since that crawl, so fetch in full once and track it.
+    logger.info(f'CHECKPOINT {entity}: no high-water mark yet, full fetch '
+                f'tracking {column}')
+    return full
+
+
+def plan_run(schemas, entity_sets, force, watermark_columns,
+             retry_failed=False):
+    """Plans every entity set from one CheckpointIndex. Returns (entity,
+    plan) pairs for the entities to scrape; see plan_entity.
+    """
+    # Listed even with `force`, for the blobs each entity leaves behind.
+    checkpoints = CheckpointIndex.load(read_all=bool(watermark_columns),
+                                       read=not force)
+    plans = []
+    for entity in entity_sets:
+        plan = plan_entity(entity, schemas[entity], force,
+                           watermark_columns, checkpoints, retry_failed)
+        if plan is not None:
+            plans.append((entity, plan))
+    logger.info(f'PLAN: {len(plans)} of {len(entity_sets)} entity sets')
+    return plans
+
+
+def delta_url(entity, entity_schema, since):
+    """URL of the rows changed since the checkpoint `since`.
+
+    Rows at the watermark itself are fetched again, since rows sharing
+    that value may have landed after the previous run read it; the
+    BigQuery MERGE on `__id` drops the repeats.
+    """
+    if since.get('delta_link'):
+        return since['delta_link']
+
+    column = since['watermark']['column']
+    value = since['watermark']['value']
+    if entity_schema[column]['sql_type'] == 'STRING':
+        literal = "'%s'" % value.replace("'", "''")
+    else:
+        literal = value
+
+    query = urlencode({'$filter': f'{column} ge {literal}',
+                       '$orderby': column},
+                      quote_via=quote, safe="$:'")
+    return f'{ODATA_ENDPOINT}/{entity}?{query}'
+
+
+def start_url(entity, entity_schema, progress):
+    if progress.next_url is not None:
+        return progress.next_url
+    if progress.state['since'] is not None:
+        return delta_url(entity, entity_schema, progress.state['since'])
+    return None
+
+
+def page_fetch_failed(entity, progress, avro, error):
+    """Handles a non-200 page. Returns True if the entity should be resumed
+    by a later run rather than finished now.
+    """
+    if progress.state['pages'] and progress.every_pages is None:
+        # Failed mid-entity with no progress kept, e.g. streaming straight
+        # to GCS: the next run starts the entity over.
+        logger.warning(f'{entity}: page failed with {error.status_code}, '
+                       f'next run re-fetches it from the start')
+        return True
+
+    if progress.state['pages']:
+        # Failed mid-entity. Keep the progress so the next run resumes.
+        logger.warning(f'PROGRESS {entity}: page failed with '
+                       f'{error.status_code}, leaving it to resume')
+        if avro is not None:
+            progress.save(avro)
+        return True
+
+    if progress.state['since'] is not None:
+        # Keep the previous checkpoint and its watermark for the next run.
+        logger.warning(f'{entity}: incremental fetch failed with '
+                       f'{error.status_code}: {error.text}')
+        return True
+
+    # No access to data. Skip!
+    write_checkpoint(entity,
+                     {'ok': False,
+                      'status_code': error.status_code,
+                      'msg': error.text})
+    return False
+
+
+def scrape_entity(entity, entity_schema, tempfile, skip_upload,
+                  http, rate_limiter, pipeline_depth=2,
+                  checkpoint_every=100, resume=True,
+                  watermark_column=None, since=None, stream_rows=None,
+                  avro_options=None, stream_upload=None, metrics=None,
+                  stored=None):
+    """Scrapes one entity set into `tempfile` and uploads it.
+
+    Fetching, transforming and Avro encoding run as a pipeline of
+    threads joined by queues of `pipeline_depth` pages (or chunks of
+    `stream_rows` rows when streaming), so the next page downloads while
+    the current one is converted and compressed.
+    Progress is saved every `checkpoint_every` pages (see EntityProgress).
+
+    With a `since` checkpoint only rows past its watermark are fetched,
+    and they are written as a new delta partition of the entity.
+    `avro_options` are passed on to AvroBlockWriter; see EntityProgress
+    for `stream_upload`.
+
+    Page and stage timings go to the EntityMetrics `metrics`, and
+    `stored` is the entity's blobs from the run's listing (see
+    EntityProgress). Returns 'ok', 'failed', or 'incomplete' when a later
+    run should resume.
+    """
+    logger.info(f'Processing {entity}')
+    if metrics is None:
+        metrics = EntityMetrics(entity)
+    progress = EntityProgress.start(
+        entity, tempfile, None if skip_upload else checkpoint_every, resume,
+        since, None if skip_upload else stream_upload, stored)
+
+    def stage(iterable):
+        # Under --profile the pipeline runs inline, under the one profiler
+        # of this thread: since 3.12 only one cProfile can be active.
+        if profiles.enabled:
+            return iterable
+        return prefetch(iterable, pipeline_depth)
+
+    pages = stage(
+        fetch_pages(entity, http, rate_limiter,
+                    start_url(entity, entity_schema, progress), stream_rows))
+    transformed = stage(
+        transform_pages(compile_page_transform(entity_schema), pages))
+    avro = None
+    completed = False
+    status = 'ok'
+    try:
+        for values, data in transformed:
+            if avro is None:
+                avro = progress.open(entity_schema, avro_options or {})
+            start = time.perf_counter()
+            avro.write(values)
+            add_page_metrics(data, encode_seconds=time.perf_counter() - start)
+            progress.observe(watermark_column, data)
+            with metrics.timed('upload'):
+                progress.page_done(avro, data, len(values))
+            metrics.page_done(data, len(values))
+        completed = True
+    except PageFetchError as e:
+        if page_fetch_failed(entity, progress, avro, e):
+            return 'incomplete'
+        status = 'failed'
+    finally:
+        transformed.close()
+        if avro:
+            with metrics.timed('upload'):
+                avro.close(commit=completed)
+
+    with metrics.timed('upload'):
+        finish_entity(entity, tempfile, avro, skip_upload, progress)
+    return status
+
+
+def scrape_all_entities(schemas, entity_sets, tempfile, force, skip_upload,
+                        workers=1, max_requests_per_second=None,
+                        pipeline_depth=2, http=None, checkpoint_every=100,
+                        watermark_columns=(), stream_rows=1000,
+                        avro_options=None, stream_upload=None,
+                        retry_failed=False, report=None):
+    """Scrapes every entity set, `workers` at a time.
+
+    Each worker writes to its own tempfile (`tempfile` suffixed with the
+    worker number when there is more than one) and all workers share one
+    rate limiter so the endpoint sees at most `max_requests_per_second`.
+
+    If `watermark_columns` is given, entities that have one of those
+    columns are synced incrementally; see plan_entity. Metrics of every
+    entity go to the RunReport `report`.
+    """
+    random.shuffle(entity_sets)
+    plans = plan_run(schemas, entity_sets, force, watermark_columns,
+                     retry_failed)
+    rate_limiter = RateLimiter(max_requests_per_second)
+    if http is None:
+        http = HttpClient(pool_size=max(10, workers))
+
+    tempfiles = queue.SimpleQueue()
+    for worker_tempfile in worker_tempfiles(tempfile, workers):
+        tempfiles.put(worker_tempfile)
+
+    def work(entity, plan):
+        worker_tempfile = tempfiles.get()
+        metrics = EntityMetrics(entity, report)
+        status = 'error'
+        try:
+            with profiles.profiled():
+                status = scrape_entity(
+                    entity, schemas[entity], worker_tempfile, skip_upload,
+                    http, rate_limiter, pipeline_depth, checkpoint_every,
+                    resume=not force, stream_rows=stream_rows,
+                    avro_options=avro_options, stream_upload=stream_upload,
+                    metrics=metrics, **plan)
+        finally:
+            metrics.done(status)
+            tempfiles.put(worker_tempfile)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(work, entity, plan)
+                   for entity, plan in plans]
+
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+        finally:
+            logger.info(f'HTTP: {http_session.stats.as_dict()}')
+
+
+async def async_fetch_pages(entity, http, rate_limiter, executor,
+                            start_url=None, stream_rows=None):
+    """Async version of fetch_pages. Buffered pages are decoded on
+    `executor`; streamed ones are parsed on the loop as they arrive.
+    """
+    loop = asyncio.get_running_loop()
+    next_url = start_url or f'{ODATA_ENDPOINT}/{entity}'
+    while next_url is not None:
+        await asyncio.sleep(rate_limiter.reserve())
+        start = time.perf_counter()
+        if not stream_rows:
+            async with http.stream(next_url) as response:
+                latency = time.perf_counter() - start
+                body = await response.read()
+            if response.status != 200:
+                raise PageFetchError(response.status,
+                                     body.decode('utf-8', 'replace'))
+
+            fetched = time.perf_counter()
+            data = await loop.run_in_executor(executor, json.loads, body)
+            add_page_metrics(data, latency_seconds=latency,
+                             fetch_seconds=fetched - start,
+                             parse_seconds=time.perf_counter() - fetched,
+                             body_bytes=len(body), retries=response.retries)
+            next_url = data.get('@odata.nextLink', None)
+            yield data
             continue
 
-        logger.info(f'Processing {entity}')
-        entity_schema = schemas[entity]
+        async with http.stream(next_url) as response:
+            if response.status != 200:
+                body = await response.read()
+                raise PageFetchError(response.status,
+                                     body.decode('utf-8', 'replace'))
+
+            reader = TimedReader(response.content, is_async=True)
+            async for data in ameasure_chunks(aiter_page(reader, stream_rows),
+                                              reader,
+                                              time.perf_counter() - start,
+                                              response.retries):
+                yield data
+        next_url = data.get('@odata.nextLink', None)
+
 
-        next_url = f'{ODATA_ENDPOINT}/{entity}'
+async def async_scrape_entity(entity, entity_schema, tempfile, skip_upload,
+                              http, rate_limiter, executor, pipeline_depth=2,
+                              checkpoint_every=100, resume=True,
+                              watermark_column=None, since=None,
+                              stream_rows=None, avro_options=None,
+                              stream_upload=None, metrics=None,
+                              stored=None):
+    """Async version of scrape_entity.
+
+    Pages are fetched on the event loop up to `pipeline_depth` ahead while
+    transform and Avro encoding of earlier pages run on `executor`.
+    """
+    logger.info(f'Processing {entity}')
+    if metrics is None:
+        metrics = EntityMetrics(entity)
+    loop = asyncio.get_running_loop()
+    progress = await asyncio.to_thread(
+        EntityProgress.start,
+        entity, tempfile, None if skip_upload else checkpoint_every, resume,
+        since, None if skip_upload else stream_upload, stored)
+    pages = asyncio.Queue(maxsize=pipeline_depth)
+
+    async def produce():
         try:
-            opened_file = None
-            while next_url is not None:
-                response = requests.get(next_url)
-                if response.status_code != 200:
-                    # No access to data. Skip!
-                    write_checkpoint(entity,
-                                     {'ok': False,
-                                      'status_code': response.status_code,
-                                      'msg': response.text})
-                    break
-
-                data = json.loads(response.text)
-                next_url = data.get('@odata.nextLink', None)
-
-                values = [
-                    {field_name:
-                     entity_schema[field_name]['transform'](field_value)
-                     for field_name, field_value
-                     in row.items()}
-                    for row in data['value']]
-
-                if opened_file is None:
-                    opened_file = open(tempfile, 'wb+')
-                    writer(opened_file,
-                           parse_schema(to_avro_schema(entity_schema, entity)),
-                           values, codec='zstandard')
-                else:
-                    writer(opened_file, None, values, codec='zstandard')
-
-            if skip_upload:
-                logger.info(f"Skipping upload for {entity}")
-                continue
+            async for data in async_fetch_pages(
+                    entity, http, rate_limiter, executor,
+                    start_url(entity, entity_schema, progress),
+                    stream_rows):
+                await pages.put((data, None))
+            await pages.put((_END, None))
+        except Exception as e:
+            await pages.put((_END, e))
 
-            if opened_file is not None:
-                opened_file.close()
-                opened_file = None
-                bucket.blob(
-                    f'{entity_path(entity)}.avro').upload_from_filename(
-                        tempfile, content_type="application/avro",
-                        retry=DEFAULT_RETRY)
-
-                write_checkpoint(entity, {'ok': True})
-            else:
-                write_checkpoint(entity, {'ok': False, 'message': 'No data?'})
+    transform_rows = compile_page_transform(entity_schema)
+
+    def encode(avro, data):
+        start = time.perf_counter()
+        values = transform_page(transform_rows, data)
+        transformed = time.perf_counter()
+        avro.write(values)
+        add_page_metrics(data, transform_seconds=transformed - start,
+                         encode_seconds=time.perf_counter() - transformed)
+        progress.observe(watermark_column, data)
+        with metrics.timed('upload'):
+            progress.page_done(avro, data, len(values))
+        metrics.page_done(data, len(values))
+
+    producer = asyncio.create_task(produce())
+    avro = None
+    completed = False
+    status = 'ok'
+    try:
+        while True:
+            data, error = await pages.get()
+            if data is _END:
+                if error is not None:
+                    raise error
+                completed = True
+                break
+
+            if avro is None:
+                avro = await asyncio.to_thread(progress.open, entity_schema,
+                                               avro_options or {})
+            await loop.run_in_executor(executor, encode, avro, data)
+    except PageFetchError as e:
+        if await asyncio.to_thread(page_fetch_failed, entity, progress,
+                                   avro, e):
+            return 'incomplete'
+        status = 'failed'
+    finally:
+        producer.cancel()
+        if avro:
+            with metrics.timed('upload'):
+                await asyncio.to_thread(avro.close, completed)
+
+    with metrics.timed('upload'):
+        await asyncio.to_thread(finish_entity, entity, tempfile, avro,
+                                skip_upload, progress)
+    return status
+
+
+async def async_scrape_all_entities(schemas, entity_sets, tempfile, force,
+                                    skip_upload, workers=1,
+                                    max_requests_per_second=None,
+                                    pipeline_depth=2, http=None,
+                                    checkpoint_every=100,
+                                    watermark_columns=(), stream_rows=1000,
+                                    avro_options=None, stream_upload=None,
+                                    retry_failed=False, report=None):
+    """Same as scrape_all_entities, but on one asyncio event loop.
+
+    `workers` entity sets are paged concurrently; transform and encode
+    work goes to a thread pool sized to the machine. Checkpoints and
+    tempfiles are laid out exactly as in the threaded engine.
+    """
+    random.shuffle(entity_sets)
+    rate_limiter = RateLimiter(max_requests_per_second)
+    if http is None:
+        http = AsyncHttpClient(pool_size=max(10, workers))
+
+    plans = await asyncio.to_thread(plan_run, schemas, entity_sets, force,
+                                    watermark_columns, retry_failed)
+
+    tempfiles = asyncio.Queue()
+    for worker_tempfile in worker_tempfiles(tempfile, workers):
+        tempfiles.put_nowait(worker_tempfile)
+
+    async def work(entity, plan):
+        worker_tempfile = await tempfiles.get()
+        metrics = EntityMetrics(entity, report)
+        status = 'error'
+        try:
+            status = await async_scrape_entity(
+                entity, schemas[entity], worker_tempfile, skip_upload, http,
+                rate_limiter, executor, pipeline_depth, checkpoint_every,
+                resume=not force, stream_rows=stream_rows,
+                avro_options=avro_options, stream_upload=stream_upload,
+                metrics=metrics, **plan)
         finally:
-            if opened_file:
-                opened_file.close()
+            metrics.done(status)
+            tempfiles.put_nowait(worker_tempfile)
+
+    with ThreadPoolExecutor() as executor:
+        try:
+            async with http:
+                async with asyncio.TaskGroup() as tasks:
+                    for entity, plan in plans:
+                        tasks.create_task(work(entity, plan))
+        finally:
+            logger.info(f'HTTP: {http_session.stats.as_dict()}')
+
+
+def load_to_bigquery(client, schemas, entity_sets, max_jobs=8, force=False):
+    """Loads the Avro files of every entity set with an ok checkpoint into
+    BigQuery through `client` (see bigquery_load.BigQueryClient), from one
+    listing of the bucket.
+    """
+    prefix = entity_path('')
+    listing = list(bucket.list_blobs(prefix=prefix))
+    checkpoints = CheckpointIndex.load(listing=listing)
+
+    # The full file, `{entity}.avro`, sorts before its deltas in
+    # `{entity}.delta/`, which sort in the order they were written.
+    sources = {}
+    for blob in listing:
+        name = blob.name[len(prefix):]
+        entity = name.split('.', 1)[0]
+        if (not name.endswith('.avro') or entity not in entity_sets
+                or not checkpoints.ok(entity)):
+            continue
+        if name == f'{entity}.avro':
+            sources[entity] = [blob]
+        elif entity in sources:
+            sources[entity].append(blob)
+
+    # Rows in the deltas are ordered by the watermark they were fetched by.
+    order_columns = {}
+    for entity, blobs in sources.items():
+        watermark = len(blobs) > 1 and checkpoints.read(entity).get(
+            'watermark')
+        if watermark:
+            order_columns[entity] = watermark['column']
+
+    try:
+        loaded = bigquery_load.load_tables(client, schemas, bucket.name,
+                                           sources, max_jobs, force,
+                                           order_columns)
+    except bigquery_load.LoadError as error:
+        loaded = error.loaded
+        raise
+    finally:
+        logger.info(f'BIGQUERY: loaded {loaded} of {len(sources)} tables')
 
 
 def main():
     parser = argparse.ArgumentParser(
         description='Snags data from ospi')
-    parser.add_argument('--metadata', type=argparse.FileType('r'),
+    parser.add_argument('--metadata', type=argparse.FileType('rb'),
                         help=('If set, use XML file for metadata instead of '
                               'getting it from the server.'))
+    parser.add_argument('--metadata-cache',
+                        default=os.path.expanduser('~/.cache/ospi-odata'),
+                        help=('Directory caching schemas parsed from '
+                              '$metadata, keyed by its hash. Empty to '
+                              'disable. Default: %(default)s'))
+    parser.add_argument('--metadata-max-age', type=float, default=0,
+                        help=('Seconds to reuse cached $metadata without '
+                              'asking the server whether it changed'))
     parser.add_argument('--log-level', default='INFO',
                         help='set log level {DEBUG, INFO, WARNING, ERROR}')
     parser.add_argument('--tempfile', required=True,
@@ -186,26 +1318,144 @@ def main():
                         help='Ignore checkpoints')
     parser.add_argument('--skip-upload', action=argparse.BooleanOptionalAction,
                         help='Do not upload. Do not make checkpoints')
+    parser.add_argument('--workers', type=int, default=1,
+                        help=('Number of entity sets to scrape at once. Each '
+                              'worker uses TEMPFILE.<n> as its tempfile.'))
+    parser.add_argument('--max-requests-per-second', type=float, default=None,
+                        help='Cap on requests/sec across all workers')
+    parser.add_argument('--pipeline-depth', type=int, default=2,
+                        help=('Pages buffered between the fetch, transform '
+                              'and encode stages of each worker'))
+    parser.add_argument('--connect-timeout', type=float, default=10.0,
+                        help='Seconds to wait for a connection')
+    parser.add_argument('--read-timeout', type=float, default=120.0,
+                        help='Seconds to wait for a response')
+    parser.add_argument('--retries', type=int, default=5,
+                        help='Retries per request on 429/5xx and errors')
+    parser.add_argument('--backoff', type=float, default=1.0,
+                        help='Exponential backoff factor between retries')
+    parser.add_argument('--checkpoint-every', type=int, default=100,
+                        help=('Upload the partial Avro and save resumable '
+                              'progress every N pages'))
+    parser.add_argument('--stream-rows', type=int, default=1000,
+                        help=('Parse pages as they download, passing rows '
+                              'on in chunks of N. 0 buffers whole pages.'))
+    parser.add_argument('--avro-block-bytes', type=int,
+                        default=DEFAULT_BLOCK_BYTES,
+                        help='End an Avro block at this much uncompressed '
+                             'data (default: %(default)s)')
+    parser.add_argument('--avro-block-rows', type=int, default=None,
+                        help='End an Avro block at this many rows')
+    parser.add_argument('--zstd-level', type=int, default=None,
+                        help='zstandard compression level for Avro blocks')
+    parser.add_argument('--stream-upload', action='store_true',
+                        help='Stream Avro straight to GCS with a resumable '
+                             'upload instead of writing --tempfile first. '
+                             'Disables --checkpoint-every')
+    parser.add_argument('--upload-chunk-mib', type=int, default=8,
+                        help='Resumable upload chunk size (and so the '
+                             'upload buffer) in MiB for --stream-upload')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Only scrape entity sets whose checkpoint '
+                             'says ok: false')
+    parser.add_argument('--incremental', action='store_true',
+                        help=('Only fetch rows past each entity\'s saved '
+                              'high-water mark, as delta partitions. Entity '
+                              'sets checkpointed without a mark, as by runs '
+                              'without --incremental, are fetched in full '
+                              'once to record it'))
+    parser.add_argument('--watermark-column', action='append',
+                        help=('Candidate high-water mark column for '
+                              '--incremental; may be repeated. '
+                              'Default: :updated_at'))
+    parser.add_argument('--bigquery-dataset',
+                        help='Load every scraped entity set into a table of '
+                             'this BigQuery dataset after scraping')
+    parser.add_argument('--bigquery-jobs', type=int, default=8,
+                        help='BigQuery load jobs to run at once')
+    parser.add_argument('--load-only', action='store_true',
+                        help='Skip scraping and only run the BigQuery load')
+    parser.add_argument('--metrics-report',
+                        help='Write per-page and per-entity metrics to this '
+                             'file as JSON lines')
+    parser.add_argument('--prometheus-file',
+                        help='Write per-entity metrics to this file in the '
+                             'Prometheus text format at the end of the run')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Run --entity-set under cProfile, with its '
+                             'pipeline stages in one thread rather than '
+                             'overlapped, and save the stats to PATH')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'],
+                        default='threads',
+                        help=('Crawler engine. With asyncio, --workers is '
+                              'the number of entity sets paged at once.'))
 
     args = parser.parse_args()
+    if args.profile and (not args.entity_set or args.engine != 'threads'):
+        parser.error('--profile needs --entity-set and the threads engine')
     logging.basicConfig(level=args.log_level)
+    http_options = dict(pool_size=max(10, args.workers),
+                        retries=args.retries,
+                        backoff_factor=args.backoff,
+                        connect_timeout=args.connect_timeout,
+                        read_timeout=args.read_timeout)
+    http = HttpClient(**http_options)
     if args.metadata:
-        metadata = ET.parse(args.metadata)
+        schemas, entity_sets = read_metadata(args.metadata,
+                                             args.metadata_cache)
     else:
-        metadata = ET.fromstring(getMetadata())
+        schemas, entity_sets = fetch_metadata(http, args.metadata_cache,
+                                              args.metadata_max_age)
 
-    schemas = get_schemas(metadata)
     if args.entity_set:
         entity_sets = [args.entity_set]
-    else:
-        entity_sets = get_entity_sets(metadata)
 
-    scrape_all_entities(
+    scrape_options = dict(
         schemas=schemas,
         entity_sets=entity_sets,
         tempfile=args.tempfile,
         force=args.force,
-        skip_upload=args.skip_upload)
+        skip_upload=args.skip_upload,
+        workers=args.workers,
+        max_requests_per_second=args.max_requests_per_second,
+        pipeline_depth=args.pipeline_depth,
+        checkpoint_every=args.checkpoint_every,
+        stream_rows=args.stream_rows,
+        avro_options=dict(block_bytes=args.avro_block_bytes,
+                          block_rows=args.avro_block_rows,
+                          compression_level=args.zstd_level),
+        retry_failed=args.retry_failed,
+        stream_upload=(args.upload_chunk_mib * 1024 * 1024
+                       if args.stream_upload and not args.skip_upload
+                       else None),
+        watermark_columns=(args.watermark_column or [':updated_at']
+                           if args.incremental else ()))
+
+    report = RunReport(args.metrics_report, args.prometheus_file)
+    profiles.enabled = bool(args.profile)
+    started = time.monotonic()
+    try:
+        if args.load_only:
+            pass
+        elif args.engine == 'asyncio':
+            asyncio.run(async_scrape_all_entities(
+                http=AsyncHttpClient(**http_options), report=report,
+                **scrape_options))
+        else:
+            scrape_all_entities(http=http, report=report, **scrape_options)
+    finally:
+        report.close(engine=args.engine,
+                     wall_seconds=round(time.monotonic() - started, 3),
+                     http=http_session.stats.as_dict())
+        if args.profile:
+            logger.info(f'PROFILE {args.entity_set}: saved to {args.profile}'
+                        f'\n{profiles.write(args.profile)}')
+
+    if args.bigquery_dataset and not args.skip_upload:
+        load_to_bigquery(
+            bigquery_load.BigQueryClient(storage_client.project,
+                                         args.bigquery_dataset),
+            schemas, entity_sets, args.bigquery_jobs, args.force)
 
 
 if __name__ == "__main__":